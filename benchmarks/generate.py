@@ -0,0 +1,341 @@
+"""Generate a synthetic site plan for benchmarking buildmap.
+
+This writes a DXF file containing a configurable number of layers and entities
+(polygons, fence lines which need combining, labels, block inserts), with XDATA
+attributes, plus a NOC network and a power network laid out as trees so the NOC
+and power plugins have something to trace. A GeoJSON file of extra features is
+written alongside it.
+
+Coordinates are in British National Grid (EPSG:27700).
+"""
+import argparse
+import json
+import math
+import random
+from pathlib import Path
+
+SOURCE_PROJECTION = "epsg:27700"
+ORIGIN = (350000.0, 180000.0)
+APP_NAME = "BUILDMAP"
+
+NOC_PREFIX = "noc ... "
+POWER_PREFIX = "power ... "
+
+
+class DXFWriter(object):
+    """Write a minimal ASCII DXF file which GDAL's DXF driver can read."""
+
+    def __init__(self):
+        self.blocks = []
+        self.entities = []
+        self.handle = 0x100
+
+    def _next_handle(self):
+        self.handle += 1
+        return "%X" % self.handle
+
+    def _entity(self, entity_type, layer, codes, attributes=None):
+        data = [(0, entity_type), (5, self._next_handle()), (8, layer)] + codes
+        if attributes:
+            data.append((1001, APP_NAME))
+            for key, value in attributes.items():
+                data.append((1000, "%s:%s" % (key, value)))
+        self.entities.append(data)
+
+    def line(self, layer, start, end, attributes=None):
+        codes = [(10, start[0]), (20, start[1]), (11, end[0]), (21, end[1])]
+        self._entity("LINE", layer, codes, attributes)
+
+    def polyline(self, layer, points, closed=False, attributes=None):
+        codes = [(90, len(points)), (70, 1 if closed else 0)]
+        for x, y in points:
+            codes += [(10, x), (20, y)]
+        self._entity("LWPOLYLINE", layer, codes, attributes)
+
+    def point(self, layer, position, attributes=None):
+        codes = [(10, position[0]), (20, position[1])]
+        self._entity("POINT", layer, codes, attributes)
+
+    def text(self, layer, position, value, height=1.0, rotation=0.0):
+        codes = [
+            (10, position[0]),
+            (20, position[1]),
+            (40, height),
+            (1, value),
+            (50, rotation),
+        ]
+        self._entity("TEXT", layer, codes)
+
+    def insert(self, layer, block, position, rotation=0.0, attributes=None):
+        codes = [(2, block), (10, position[0]), (20, position[1]), (50, rotation)]
+        self._entity("INSERT", layer, codes, attributes)
+
+    def block(self, name, entities):
+        """Define a block. `entities` is a list of (entity type, codes) tuples."""
+        self.blocks.append((name, entities))
+
+    def write(self, path):
+        lines = []
+
+        def emit(code, value):
+            if isinstance(value, float):
+                value = "%.4f" % value
+            lines.append(str(code))
+            lines.append(str(value))
+
+        def section(name):
+            emit(0, "SECTION")
+            emit(2, name)
+
+        section("HEADER")
+        emit(9, "$ACADVER")
+        emit(1, "AC1015")
+        emit(0, "ENDSEC")
+
+        section("TABLES")
+        emit(0, "TABLE")
+        emit(2, "APPID")
+        emit(70, 1)
+        emit(0, "APPID")
+        emit(2, APP_NAME)
+        emit(70, 0)
+        emit(0, "ENDTAB")
+        emit(0, "ENDSEC")
+
+        section("BLOCKS")
+        for name, entities in self.blocks:
+            for code, value in [(0, "BLOCK"), (8, "0"), (2, name), (70, 0)]:
+                emit(code, value)
+            for code, value in [(10, 0.0), (20, 0.0), (30, 0.0), (3, name)]:
+                emit(code, value)
+            for entity_type, codes in entities:
+                emit(0, entity_type)
+                emit(8, "0")
+                for code, value in codes:
+                    emit(code, value)
+            emit(0, "ENDBLK")
+        emit(0, "ENDSEC")
+
+        section("ENTITIES")
+        for entity in self.entities:
+            for code, value in entity:
+                emit(code, value)
+        emit(0, "ENDSEC")
+        emit(0, "EOF")
+
+        with open(path, "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+
+
+class SitePlanGenerator(object):
+    def __init__(
+        self,
+        layers=20,
+        entities=500,
+        attributes=3,
+        blocks=200,
+        switches=50,
+        distros=50,
+        seed=1,
+    ):
+        self.layers = layers
+        self.entities = entities
+        self.attributes = attributes
+        self.blocks = blocks
+        self.switches = switches
+        self.distros = distros
+        self.random = random.Random(seed)
+        # Scale the site so that entity density stays roughly constant
+        self.size = max(200.0, math.sqrt(layers * entities) * 20)
+
+    def scale(self):
+        return {
+            "layers": self.layers,
+            "entities": self.entities,
+            "attributes": self.attributes,
+            "blocks": self.blocks,
+            "switches": self.switches,
+            "distros": self.distros,
+        }
+
+    def position(self):
+        return (
+            ORIGIN[0] + self.random.uniform(0, self.size),
+            ORIGIN[1] + self.random.uniform(0, self.size),
+        )
+
+    def attributes_for(self, index):
+        return {
+            "attr%d" % i: "value%d" % self.random.randint(0, index + 1)
+            for i in range(self.attributes)
+        }
+
+    def layer_names(self):
+        return ["terrain ... layer %d" % i for i in range(self.layers)]
+
+    def fence_layer(self):
+        return "terrain ... fence"
+
+    def tree_layer(self):
+        return "objects ... tree"
+
+    def write_dxf(self, path):
+        dxf = DXFWriter()
+
+        for index, layer in enumerate(self.layer_names()):
+            for i in range(self.entities):
+                x, y = self.position()
+                kind = i % 3
+                if kind == 0:
+                    # Tent
+                    w, h = self.random.uniform(2, 10), self.random.uniform(2, 10)
+                    dxf.polyline(
+                        layer,
+                        [(x, y), (x + w, y), (x + w, y + h), (x, y + h)],
+                        closed=True,
+                        attributes=self.attributes_for(i),
+                    )
+                elif kind == 1:
+                    # Path
+                    points = [(x, y)]
+                    for _ in range(self.random.randint(2, 8)):
+                        x += self.random.uniform(-10, 10)
+                        y += self.random.uniform(-10, 10)
+                        points.append((x, y))
+                    dxf.polyline(layer, points, attributes=self.attributes_for(i))
+                else:
+                    dxf.text(
+                        layer,
+                        (x, y),
+                        "Label %d on layer %d" % (i, index),
+                        height=self.random.uniform(0.5, 4),
+                        rotation=self.random.uniform(0, 360),
+                    )
+
+        # Fences drawn as separate segments with nearly-touching ends, for combine_lines
+        for i in range(max(1, self.entities // 10)):
+            x, y = self.position()
+            for _ in range(self.random.randint(3, 12)):
+                nx = x + self.random.uniform(-20, 20)
+                ny = y + self.random.uniform(-20, 20)
+                dxf.line(self.fence_layer(), (x, y), (nx, ny))
+                x = nx + self.random.uniform(-0.3, 0.3)
+                y = ny + self.random.uniform(-0.3, 0.3)
+
+        dxf.block(
+            "TREE",
+            [
+                ("CIRCLE", [(10, 0.0), (20, 0.0), (40, 2.0)]),
+                ("LINE", [(10, -1.0), (20, 0.0), (11, 1.0), (21, 0.0)]),
+                ("LINE", [(10, 0.0), (20, -1.0), (11, 0.0), (21, 1.0)]),
+            ],
+        )
+        for i in range(self.blocks):
+            dxf.insert(
+                self.tree_layer(),
+                "TREE",
+                self.position(),
+                rotation=self.random.uniform(0, 360),
+                attributes={"species": "tree%d" % (i % 5)},
+            )
+
+        self.write_noc(dxf)
+        self.write_power(dxf)
+        dxf.write(path)
+
+    def write_noc(self, dxf):
+        switches = []
+        for i in range(self.switches):
+            name = "SWCORE" if i == 0 else "SW%03d" % i
+            position = self.position()
+            dxf.point(NOC_PREFIX + "switch", position, {"switch": name})
+            if i > 0:
+                parent = switches[self.random.randrange(len(switches))]
+                layer = "fibre" if self.random.random() < 0.3 else "copper"
+                dxf.line(
+                    NOC_PREFIX + layer,
+                    parent,
+                    position,
+                    {"cores": 2 if layer == "fibre" else 1},
+                )
+            switches.append(position)
+
+    def write_power(self, dxf):
+        generator = self.position()
+        dxf.point(POWER_PREFIX + "generator", generator, {"generator": "GEN100"})
+        nodes = [generator]
+        for i in range(self.distros):
+            position = self.position()
+            dxf.point(
+                POWER_PREFIX + "distro",
+                position,
+                {"distro": "DISTRO63", "name": "DIST%03d" % i},
+            )
+            parent = nodes[self.random.randrange(len(nodes))]
+            dxf.line(POWER_PREFIX + "63-3", parent, position)
+            nodes.append(position)
+
+    def write_geojson(self, path):
+        features = []
+        for i in range(self.entities):
+            x, y = self.position()
+            features.append(
+                {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [x, y]},
+                    "properties": dict(self.attributes_for(i), name="Point %d" % i),
+                }
+            )
+        data = {
+            "type": "FeatureCollection",
+            "crs": {
+                "type": "name",
+                "properties": {"name": "urn:ogc:def:crs:EPSG::27700"},
+            },
+            "features": features,
+        }
+        with open(path, "w") as fp:
+            json.dump(data, fp)
+
+    def generate(self, out_dir: Path):
+        """Write the site plan to `out_dir`, returning the paths of the DXF and
+        GeoJSON files."""
+        out_dir.mkdir(parents=True, exist_ok=True)
+        dxf_path = out_dir / "site_plan.dxf"
+        geojson_path = out_dir / "extra.geojson"
+        self.write_dxf(dxf_path)
+        self.write_geojson(geojson_path)
+        return dxf_path, geojson_path
+
+
+def add_scale_arguments(parser):
+    parser.add_argument("--layers", type=int, default=20)
+    parser.add_argument("--entities", type=int, default=500, help="Entities per layer")
+    parser.add_argument(
+        "--attributes", type=int, default=3, help="XDATA attributes per entity"
+    )
+    parser.add_argument("--blocks", type=int, default=200, help="Block inserts")
+    parser.add_argument("--switches", type=int, default=50)
+    parser.add_argument("--distros", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def generator_from_args(args):
+    return SitePlanGenerator(
+        layers=args.layers,
+        entities=args.entities,
+        attributes=args.attributes,
+        blocks=args.blocks,
+        switches=args.switches,
+        distros=args.distros,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic site plan")
+    parser.add_argument("output", help="Output directory")
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+    for path in generator_from_args(args).generate(Path(args.output)):
+        print(path)
@@ -0,0 +1,227 @@
+"""End-to-end benchmark for buildmap.
+
+Generates a synthetic site plan (see `generate.py`), runs buildmap against it
+with `--profile` a number of times, and reports the median wall time of each
+profiled stage: every ogr2ogr import, every MapDB transform, each plugin and
+each exporter.
+
+Results can be saved as a baseline and compared against later runs:
+
+    python benchmarks/run.py --db-url postgresql://... --save-baseline
+    python benchmarks/run.py --db-url postgresql://...
+
+The comparison exits with a non-zero status if any stage is slower than the
+baseline by more than `--threshold` (and by more than `--min-delta` seconds, to
+avoid flagging noise in very short stages).
+
+Everything in the database pointed to by `--db-url` may be overwritten.
+"""
+import argparse
+import json
+import logging
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from buildmap.main import BuildMap  # noqa: E402
+from generate import (  # noqa: E402
+    NOC_PREFIX,
+    POWER_PREFIX,
+    SOURCE_PROJECTION,
+    add_scale_arguments,
+    generator_from_args,
+)
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+log = logging.getLogger("benchmark")
+
+
+def write_config(workdir: Path, generator, dxf_path, geojson_path, args):
+    """Write map and local config files for the generated site plan, returning
+    their paths."""
+    layers = generator.layer_names() + [generator.fence_layer(), generator.tree_layer()]
+    map_config = {
+        "source_projection": SOURCE_PROJECTION,
+        "zoom_range": [14, 18],
+        "plugins": {},
+        "source_file": {
+            "site_plan": {
+                "path": str(dxf_path),
+                "layers": layers,
+                "auto_import_layers": "true",
+                "combine_lines": [generator.fence_layer()],
+                "force_polygon": [generator.layer_names()[0]],
+            },
+            "extra": {"path": str(geojson_path), "auto_import_layers": "true"},
+        },
+        "vector_layer": [
+            {
+                "name": "Terrain",
+                "layer_style": {
+                    "terrain": {
+                        "layers": generator.layer_names(),
+                        "line-color": "black",
+                    },
+                    "extra": {"line-color": "red"},
+                },
+            }
+        ],
+        "mapbox_vector_layer": {},
+    }
+    if "noc" in args.plugins:
+        map_config["plugins"]["noc"] = {
+            "layer_prefix": NOC_PREFIX,
+            "core": "SWCORE",
+        }
+    if "power" in args.plugins:
+        map_config["plugins"]["power"] = {"layer_prefix": POWER_PREFIX}
+
+    local_config = {
+        "db_url": args.db_url,
+        "web_directory": str(workdir / "web"),
+        "output_directory": str(workdir / "output"),
+        "import_workers": args.workers,
+        "transform_workers": args.workers,
+    }
+
+    map_path = workdir / "map.conf.json"
+    local_path = workdir / "local.conf.json"
+    with open(map_path, "w") as fp:
+        json.dump(map_config, fp, indent=4)
+    with open(local_path, "w") as fp:
+        json.dump(local_config, fp, indent=4)
+    return map_path, local_path
+
+
+def run_once(config_paths):
+    """Run buildmap once, returning a dict of stage name to wall time."""
+    start = time.perf_counter()
+    buildmap = BuildMap([str(path) for path in config_paths] + ["--profile"])
+    buildmap.run()
+    total = time.perf_counter() - start
+
+    if not buildmap.profiler.events:
+        raise RuntimeError("buildmap did not run - is the database available?")
+
+    timings = defaultdict(float)
+    for event in buildmap.profiler.events:
+        timings["%s: %s" % (event["cat"], event["name"])] += event["args"]["wall_time"]
+    timings["total"] = total
+    return timings
+
+
+def compare(results, baseline, threshold, min_delta):
+    """Log the results against the baseline, returning a list of regressed stages."""
+    regressions = []
+    log.info("%-60s %10s %10s %8s", "Stage", "Median (s)", "Base (s)", "Change")
+    for stage, median in sorted(results.items()):
+        base = baseline.get(stage)
+        if base is None:
+            log.info("%-60.60s %10.2f %10s %8s", stage, median, "-", "new")
+            continue
+        change = (median - base) / base if base > 0 else 0.0
+        regressed = change > threshold and median - base > min_delta
+        log.info(
+            "%-60.60s %10.2f %10.2f %+7.1f%%%s",
+            stage,
+            median,
+            base,
+            change * 100,
+            " REGRESSION" if regressed else "",
+        )
+        if regressed:
+            regressions.append(stage)
+    for stage in sorted(set(baseline) - set(results)):
+        log.info("%-60.60s %10s %10.2f %8s", stage, "-", baseline[stage], "missing")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark buildmap end-to-end")
+    parser.add_argument(
+        "--db-url", required=True, help="PostGIS database to run against"
+    )
+    parser.add_argument(
+        "--workdir", help="Directory for generated data and output (default: temp)"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Import and transform workers"
+    )
+    parser.add_argument(
+        "--plugins",
+        default="noc,power",
+        help="Comma-separated plugins to run (default: %(default)s)",
+    )
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Save results as the baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slowdown which counts as a regression (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=0.5,
+        help="Ignore slowdowns smaller than this many seconds (default: %(default)s)",
+    )
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+    args.plugins = [p for p in args.plugins.split(",") if p]
+
+    logging.basicConfig(level=logging.INFO, format="%(name)-16s %(message)s")
+    # Keep buildmap's own output to warnings and above
+    logging.getLogger().setLevel(logging.WARNING)
+    log.setLevel(logging.INFO)
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="buildmap-bench-"))
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    generator = generator_from_args(args)
+    log.info("Generating site plan in %s: %s", workdir, generator.scale())
+    dxf_path, geojson_path = generator.generate(workdir / "source")
+    config_paths = write_config(workdir, generator, dxf_path, geojson_path, args)
+
+    runs = defaultdict(list)
+    for i in range(args.repeat):
+        log.info("Run %d of %d...", i + 1, args.repeat)
+        for stage, wall_time in run_once(config_paths).items():
+            runs[stage].append(wall_time)
+    results = {stage: statistics.median(times) for stage, times in runs.items()}
+
+    scale = dict(generator.scale(), plugins=args.plugins, workers=args.workers)
+    if args.save_baseline:
+        with open(args.baseline, "w") as fp:
+            json.dump({"scale": scale, "stages": results}, fp, indent=2, sort_keys=True)
+        log.info("Baseline saved to %s", args.baseline)
+
+    if not args.baseline.exists():
+        compare(results, {}, args.threshold, args.min_delta)
+        return 0
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    if baseline["scale"] != scale:
+        log.warning(
+            "Baseline was recorded at a different scale (%s), results may not be comparable",
+            baseline["scale"],
+        )
+    regressions = compare(results, baseline["stages"], args.threshold, args.min_delta)
+    if regressions:
+        log.error("%d stages regressed: %s", len(regressions), ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
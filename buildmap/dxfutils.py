@@ -1,3 +1,6 @@
+import re
+
+
 def parse_attributes(rawcodevalues: list) -> dict:
     """Given a `rawcodevalues` array from a DB table produced by ogr2ogr,
     extract the DXF extended attributes and return them as a dict.
@@ -12,3 +15,68 @@ def parse_attributes(rawcodevalues: list) -> dict:
             attributes[key.lower()] = val.replace("-", " ")
 
     return attributes
+
+
+def parse_text_style(encoded: str) -> dict:
+    """Parse an OGR label style string, as produced by the DXF driver for text
+    entities, into a dict of its parameters. Returns None if it's not a label style.
+
+        LABEL(f:"Arial",t:"A/V",s:2g,p:5,c:#000026)
+        LABEL(f:"Arial",t:"track 3 \\"test\\"",s:4g,p:5,c:#000026)
+    """
+    if encoded[0:6] != "LABEL(":
+        return None
+    index = 6
+    style = {}
+    while True:
+        if encoded[index] == ")":
+            break
+        pos = encoded.find(":", index)
+        key = encoded[index:pos]
+        index = pos + 1
+        if encoded[index] == '"':
+            i = index + 1
+            value = ""
+            while i < len(encoded):
+                if encoded[i : i + 2] == "\\\\":
+                    value += "\\"
+                    i += 2
+                elif encoded[i : i + 2] == '\\"':
+                    value += '"'
+                    i += 2
+                elif encoded[i] == '"':
+                    break
+                else:
+                    value += encoded[i]
+                    i += 1
+            index = i + 2
+        else:
+            pos = encoded.find(",", index)
+            if pos == -1:
+                value = encoded[index:-1]
+                index += len(value)
+            else:
+                value = encoded[index:pos]
+                index = pos + 1
+        style[key] = value
+    return style
+
+
+def _style_number(value):
+    """Return the number at the start of a style value such as "2g" or "12pt"."""
+    match = re.match(r"-?[0-9]*\.?[0-9]+", value or "")
+    if match is None:
+        return None
+    return float(match.group(0))
+
+
+def text_style_properties(encoded: str) -> dict:
+    """Return the `text_size`, `text_rotation`, `text_font` and `text_colour` of a
+    label from its OGR style string. Missing values are None."""
+    style = parse_text_style(encoded) or {}
+    return {
+        "text_size": _style_number(style.get("s")),
+        "text_rotation": _style_number(style.get("a")),
+        "text_font": style.get("f"),
+        "text_colour": style.get("c"),
+    }
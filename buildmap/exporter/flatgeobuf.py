@@ -0,0 +1,96 @@
+import os
+import subprocess
+import time
+from ..util import build_options, run_parallel
+from .geojson import GeoJSONExporter
+
+
+class FlatGeobufExporter(GeoJSONExporter):
+    """Write each vector layer as a FlatGeobuf file with a packed Hilbert R-tree
+    index, so clients can fetch only the features in their viewport with HTTP
+    range requests.
+
+    Layers are written by ogr2ogr straight from PostGIS, with the same source
+    table and properties (including the `properties` option) as the GeoJSON
+    exporter. Files are written to `<web_directory>/vector/<layer>.fgb`.
+
+    Config (all optional):
+
+        "flatgeobuf": {
+            "workers": 4    # number of ogr2ogr processes
+        }
+    """
+
+    def export(self):
+        start_time = time.time()
+        opts = self.config.get("flatgeobuf")
+        opts = opts if isinstance(opts, dict) else {}
+        self.log.info("Exporting FlatGeobuf layers...")
+        self.prepare_output()
+
+        run_parallel(
+            self.export_layer,
+            self.config["vector_layer"],
+            int(opts.get("workers", 1)),
+            lambda layer: "Exporting FlatGeobuf layer %s" % layer["name"],
+        )
+
+        self.log.info(
+            "FlatGeobuf generation complete in %.2f seconds", time.time() - start_time
+        )
+
+    def layer_sql(self, source_layers, source_table, attributes, keep=None):
+        """Return the SQL for ogr2ogr to read a layer with. ogr2ogr can't take bind
+        parameters, so the layer names are quoted into the query."""
+        columns = self.property_columns(attributes, keep) + [
+            "ST_Transform(wkb_geometry, 4326) AS wkb_geometry"
+        ]
+        return "SELECT %s FROM %s WHERE layer IN (%s)" % (
+            ", ".join(columns),
+            source_table,
+            ", ".join("'%s'" % layer.replace("'", "''") for layer in source_layers),
+        )
+
+    def export_layer(self, layer):
+        name = layer["name"]
+        source_layers = self.source_layers(layer)
+        keep = layer.get("properties")
+        source_table, attributes = self.layer_source(source_layers, keep)
+        if source_table is None:
+            return
+
+        output_path = self.output_dir / ("%s.fgb" % name)
+        # The FlatGeobuf driver needs the .fgb extension, or it writes a directory
+        temp_path = output_path.with_name("%s.tmp.fgb" % name)
+        if temp_path.exists():
+            temp_path.unlink()
+
+        ogr_opts = {
+            "-f": "FlatGeobuf",
+            "-lco": "SPATIAL_INDEX=YES",
+            "-nln": name,
+            "-a_srs": "EPSG:4326",
+            "-sql": self.layer_sql(source_layers, source_table, attributes, keep),
+        }
+        command = (
+            ["ogr2ogr"]
+            + list(build_options(ogr_opts))
+            + [
+                str(temp_path),
+                f"PG:{self.db.url.render_as_string(False)}?application_name=buildmap",
+            ]
+        )
+
+        self.log.info("Exporting FlatGeobuf layer %s...", name)
+        # Several layers may be written at once, so log ogr2ogr's output against
+        # the layer name rather than letting it interleave on the console.
+        result = subprocess.run(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        for line in result.stdout.splitlines():
+            self.log.info("[%s] %s", name, line)
+        result.check_returncode()
+        os.replace(temp_path, output_path)
@@ -1,28 +1,58 @@
+import gzip
 import json
+import os
+import shutil
 import time
 from sqlalchemy import text
+from ..util import run_parallel
 from . import Exporter
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 class GeoJSONExporter(Exporter):
-    """Render layers as untiled GeoJSON for display."""
+    """Render layers as untiled GeoJSON for display.
+
+    If `geojson_workers` is set in the config, up to that many layers are exported
+    at once, each on its own database connection.
+    """
+
+    # Decimal places in coordinates, unless a layer sets "precision". This is
+    # ST_AsGeoJSON's own default, so output is unchanged unless a layer sets it;
+    # 7 places is about a centimetre.
+    DEFAULT_PRECISION = 9
 
     def export(self):
         start_time = time.time()
         self.log.info("Exporting vector layers...")
-        self.source_tables = dict(
-            (table, layer) for layer, table in self.buildmap.get_source_layers()
-        )
-        self.output_dir = (
-            self.buildmap.resolve_path(self.config["web_directory"]) / "vector"
-        )
+        self.prepare_output()
+        if brotli is None:
+            self.log.warning(
+                "The brotli module isn't installed, so .br files won't be written "
+                "(install buildmap[brotli] to enable them)"
+            )
 
-        self.output_dir.mkdir(parents=True, exist_ok=True)
+        workers = int(self.config.get("geojson_workers", 1))
 
-        for layer in self.config["vector_layer"]:
-            layer_name = layer["name"]
-            self.log.info("Exporting vector layer %s...", layer_name)
-            self.generate_layer(layer_name, self.source_layers(layer))
+        def export_layer(layer):
+            self.log.info("Exporting vector layer %s...", layer["name"])
+            if workers > 1:
+                with self.db.worker() as db:
+                    self.generate_layer(
+                        layer["name"], self.source_layers(layer), layer, db
+                    )
+            else:
+                self.generate_layer(layer["name"], self.source_layers(layer), layer)
+
+        run_parallel(
+            export_layer,
+            self.config["vector_layer"],
+            workers,
+            lambda layer: "Exporting vector layer %s" % layer["name"],
+        )
 
         self.generate_layer_index()
 
@@ -30,8 +60,18 @@ class GeoJSONExporter(Exporter):
             "Vector layer generation complete in %.2f seconds", time.time() - start_time
         )
 
-    def run_query(self, query, **kwargs):
-        return self.db.execute(text(query), **kwargs).fetchall()
+    def prepare_output(self):
+        """Find the source table of each source layer, and create the output directory."""
+        self.source_tables = dict(
+            (table, layer) for layer, table in self.buildmap.get_source_layers()
+        )
+        self.output_dir = (
+            self.buildmap.resolve_path(self.config["web_directory"]) / "vector"
+        )
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def run_query(self, db, query, **kwargs):
+        return db.execute(text(query), **kwargs).fetchall()
 
     def source_layers(self, layer):
         result = []
@@ -42,54 +82,17 @@ class GeoJSONExporter(Exporter):
                 result.append(layer_name)
         return result
 
-    def parse_text_style(self, encoded):
-        # LABEL(f:"Arial",t:"A/V",s:2g,p:5,c:#000026)
-        # LABEL(f:"Arial",t:"track 3 \"test\"",s:4g,p:5,c:#000026)
-        if encoded[0:6] != "LABEL(":
-            return None
-        index = 6
-        style = {}
-        while True:
-            if encoded[index] == ")":
-                break
-            pos = encoded.find(":", index)
-            key = encoded[index:pos]
-            index = pos + 1
-            if encoded[index] == '"':
-                i = index + 1
-                value = ""
-                while i < len(encoded):
-                    if encoded[i : i + 2] == "\\\\":
-                        value += "\\"
-                        i += 2
-                    elif encoded[i : i + 2] == '\\"':
-                        value += '"'
-                        i += 2
-                    elif encoded[i] == '"':
-                        break
-                    else:
-                        value += encoded[i]
-                        i += 1
-                index = i + 2
-            else:
-                pos = encoded.find(",", index)
-                if pos == -1:
-                    value = encoded[index:-1]
-                    index += len(value)
-                else:
-                    value = encoded[index:pos]
-                    index = pos + 1
-            style[key] = value
-        return style
-
-    def generate_layer(self, name, source_layers):
+    def layer_source(self, source_layers, keep=None):
+        """Return the source table for a vector layer, and the attributes to export,
+        or `(None, None)` if any of the source layers are unknown. If `keep` is
+        set, only attributes in it are exported."""
         for layer in source_layers:
             if layer not in self.source_tables:
                 self.log.error(
                     "Source layer '%s' is unknown. Make sure it's defined in the config.",
                     layer,
                 )
-                return
+                return None, None
 
         # NB: this assumes all source layers for a vector layer exist in the
         # same source table (i.e. come from the same DXF).
@@ -98,19 +101,63 @@ class GeoJSONExporter(Exporter):
         attributes = self.buildmap.known_attributes[source_table] | set(
             ["entityhandle"]
         )
+        if keep is not None:
+            attributes = attributes & set(keep)
+        return source_table, attributes
+
+    def property_columns(self, attributes, keep=None):
+        """Return the columns which become feature properties, in order."""
+        return [
+            col
+            for col in dict.fromkeys(["layer", "text"] + sorted(attributes))
+            if keep is None or col in keep
+        ]
+
+    def generate_layer(self, name, source_layers, options=None, db=None):
+        """Write a vector layer. `options` is the layer's config, which may set
+        `precision` (the number of decimal places in coordinates) and `properties`
+        (a list of the only properties to include).
+
+        The layer is written to a temporary file and moved into place, so a
+        partially-written layer is never served."""
+        options = options or {}
+        db = db or self.db
+        keep = options.get("properties")
+        source_table, attributes = self.layer_source(source_layers, keep)
+        if source_table is None:
+            return
+
+        precision = int(options.get("precision", self.DEFAULT_PRECISION))
+
+        output_path = self.output_dir / ("%s.json" % name)
+        temp_path = output_path.with_name(output_path.name + ".tmp")
+        if self.config.get("geojson_streaming", False):
+            generate = self.generate_layer_streaming
+        else:
+            generate = self.generate_layer_buffered
+        generate(
+            db, temp_path, source_layers, source_table, attributes, precision, keep
+        )
+        self.write_compressed(temp_path, output_path)
+        os.replace(temp_path, output_path)
+
+    def generate_layer_buffered(
+        self, db, output_path, source_layers, source_table, attributes, precision, keep
+    ):
         attributes_str = ",".join(attributes)
         if len(attributes) > 0:
             attributes_str += ","
 
-        query = """SELECT layer, text, ogr_style, %s ST_AsGeoJSON(ST_Transform(wkb_geometry, 4326)) AS geojson
+        query = """SELECT layer, text, %s ST_AsGeoJSON(ST_Transform(wkb_geometry, 4326), %d) AS geojson
                     FROM %s WHERE layer = ANY (:layers)""" % (
             attributes_str,
+            precision,
             source_table,
         )
 
         result = []
 
-        for feature in self.run_query(query, layers=source_layers):
+        for feature in self.run_query(db, query, layers=source_layers):
             gj = {
                 "type": "Feature",
                 "geometry": json.loads(feature["geojson"]),
@@ -119,17 +166,13 @@ class GeoJSONExporter(Exporter):
             gj["properties"]["layer"] = feature["layer"]
             if feature["text"] is not None:
                 gj["properties"]["text"] = feature["text"]
-                style = self.parse_text_style(feature["ogr_style"])
-                size_string_raw = style["s"]
-                pos = size_string_raw.find("g")
-                size_string = size_string_raw[0:pos]
-                size = float(size_string)
-                gj["properties"]["text_size"] = size
-                if "a" in style:
-                    gj["properties"]["text_rotation"] = float(style["a"])
             for attr in attributes:
                 if attr in feature and feature[attr] is not None:
                     gj["properties"][attr] = feature[attr]
+            if keep is not None:
+                gj["properties"] = {
+                    k: v for k, v in gj["properties"].items() if k in keep
+                }
             result.append(gj)
 
         geojson = {
@@ -138,11 +181,70 @@ class GeoJSONExporter(Exporter):
             "features": result,
         }
 
-        output_path = self.output_dir / ("%s.json" % name)
-
         with output_path.open("w") as fp:
             json.dump(geojson, fp, indent=4)
 
+    def generate_layer_streaming(
+        self, db, output_path, source_layers, source_table, attributes, precision, keep
+    ):
+        """Write a layer with each feature serialised to JSON by PostGIS, reading
+        them through a server-side cursor and writing them out as they arrive, so
+        memory use doesn't depend on the size of the layer."""
+        query = """SELECT json_build_object(
+                        'type', 'Feature',
+                        'geometry', ST_AsGeoJSON(ST_Transform(t.wkb_geometry, 4326), %d)::json,
+                        'properties', jsonb_strip_nulls(to_jsonb(p))
+                    )::text AS feature
+                    FROM %s AS t, LATERAL (SELECT %s) AS p
+                    WHERE t.layer = ANY (:layers)""" % (
+            precision,
+            source_table,
+            ", ".join("t.%s" % col for col in self.property_columns(attributes, keep)),
+        )
+
+        # psycopg2 can only use a server-side cursor inside a transaction
+        with db.conn.begin():
+            result = db.conn.execution_options(stream_results=True).execute(
+                text(query), layers=source_layers
+            )
+            with output_path.open("w") as fp:
+                fp.write(
+                    '{"type": "FeatureCollection", '
+                    '"crs": {"type": "name", "properties": {"name": "EPSG:4326"}}, '
+                    '"features": ['
+                )
+                first = True
+                for row in result:
+                    if not first:
+                        fp.write(",")
+                    fp.write(row["feature"])
+                    first = False
+                fp.write("]}\n")
+            result.close()
+
+    def write_compressed(self, source, path):
+        """Write gzip and (if the brotli module is available) brotli compressed
+        copies of `source` alongside `path`, for web servers to serve directly."""
+        temp_path = str(path) + ".gz.tmp"
+        with source.open("rb") as src, gzip.open(
+            temp_path, "wb", compresslevel=9
+        ) as dest:
+            shutil.copyfileobj(src, dest)
+        os.replace(temp_path, str(path) + ".gz")
+
+        if brotli is None:
+            # Don't leave a stale copy from a previous build to be served
+            if os.path.exists(str(path) + ".br"):
+                os.remove(str(path) + ".br")
+            return
+        temp_path = str(path) + ".br.tmp"
+        compressor = brotli.Compressor(quality=11)
+        with source.open("rb") as src, open(temp_path, "wb") as dest:
+            for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                dest.write(compressor.process(chunk))
+            dest.write(compressor.finish())
+        os.replace(temp_path, str(path) + ".br")
+
     def generate_layer_index(self):
         vector_layers = []
         for layer in self.config["vector_layer"]:
@@ -161,9 +263,12 @@ class GeoJSONExporter(Exporter):
             self.buildmap.resolve_path(self.config["web_directory"])
             / "vector_layers.json"
         )
+        temp_path = output_path.with_name(output_path.name + ".tmp")
 
-        with output_path.open("w") as fp:
+        with temp_path.open("w") as fp:
             json.dump(data, fp, indent=4)
+        self.write_compressed(temp_path, output_path)
+        os.replace(temp_path, output_path)
 
     def generate_styles(self):
         styles = {}
@@ -1,11 +1,13 @@
 import os
 from os import path
-import distutils.spawn
+from pathlib import Path
+import hashlib
 import subprocess
 import shutil
 import json
+import time
 
-from ..util import sanitise_layer
+from ..util import lonlat_to_tile, run_parallel, sanitise_layer, tile_to_lonlat
 from . import Exporter
 
 
@@ -32,12 +34,18 @@ class MapnikExporter(Exporter):
             )
 
         #  Call magnacarto to build a Mapnik .xml file from each destination layer .mml file.
-        self.dest_layers = {}
         # dest_layers is saved for use if preseed() is called
-        for layer_name, mml_file in mml_files:
-            self.dest_layers[layer_name] = self.generate_mapnik_xml(
-                layer_name, mml_file
+        self.dest_layers = dict(
+            zip(
+                [layer_name for layer_name, _ in mml_files],
+                run_parallel(
+                    lambda mml: self.generate_mapnik_xml(*mml),
+                    mml_files,
+                    int(self.config.get("magnacarto_workers", os.cpu_count())),
+                    lambda mml: "Compiling %s" % mml[0],
+                ),
             )
+        )
 
     def get_layer_css(self):
         """Return the paths of all CSS files (which correspond to destination layers)"""
@@ -51,13 +59,23 @@ class MapnikExporter(Exporter):
             )
         return [f for f in files if path.isfile(f)]
 
-    def mml_layer(self, query, name):
-        """Generate a layer structure for a MML file"""
+    def mml_layer(self, query, name, projected=False):
+        """Generate a layer structure for a MML file.
+
+        If `projected` is set, the query includes the geom_3857 column and we're
+        rendering in Web Mercator, so that column is used to avoid reprojecting.
+        """
+        if projected and self.buildmap.dest_projection == "epsg:3857":
+            geometry_field, srs = "geom_3857", "epsg:3857"
+        else:
+            geometry_field, srs = "wkb_geometry", self.config["source_projection"]
+
         data_source = {
             "extent": list(reversed(self.buildmap.get_bbox().bounds)),
             "table": query,
             "type": "postgis",
             "dbname": self.db.url.database,
+            "geometry_field": geometry_field,
         }
         if self.db.url.host:
             data_source["host"] = self.db.url.host
@@ -69,7 +87,7 @@ class MapnikExporter(Exporter):
         layer_struct = {
             "name": sanitise_layer(name),
             "id": sanitise_layer(name),
-            "srs": "+init=%s" % self.config["source_projection"],
+            "srs": "+init=%s" % srs,
             "extent": list(reversed(self.buildmap.get_bbox().bounds)),
             "Datasource": data_source,
         }
@@ -83,6 +101,7 @@ class MapnikExporter(Exporter):
                                 FROM %s WHERE layer='%s') as %s"""
                 % (table_name, layer_name, table_name),
                 layer_name,
+                projected=True,
             )
             layers.append(l)
 
@@ -114,13 +133,71 @@ class MapnikExporter(Exporter):
 
         return (dest_layer_name, dest_file)
 
-    def generate_mapnik_xml(self, layer_name, mml_file):
-        # TODO: magnacarto error handling
-        output = subprocess.check_output(["magnacarto", "-mml", mml_file])
+    def magnacarto_cache_dir(self) -> Path:
+        """Return the directory for compiled Mapnik XML. This is outside the output
+        directory, which is emptied on every run."""
+        if "magnacarto_cache_dir" in self.config:
+            cache_dir = self.buildmap.resolve_path(self.config["magnacarto_cache_dir"])
+        else:
+            cache_dir = (
+                Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+                / "buildmap"
+                / "magnacarto"
+            )
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        return cache_dir
+
+    def magnacarto_cache_key(self, mml_file):
+        """Hash the inputs to magnacarto: the MML file, the stylesheets it uses, and
+        its location (as magnacarto resolves relative paths from there)."""
+        digest = hashlib.sha256()
+        digest.update(path.abspath(mml_file).encode())
+        with open(mml_file, "rb") as fp:
+            mml_data = fp.read()
+        digest.update(mml_data)
+        for stylesheet in json.loads(mml_data)["Stylesheet"]:
+            with open(path.join(path.dirname(mml_file), stylesheet), "rb") as fp:
+                digest.update(fp.read())
+        return digest.hexdigest()
 
+    def generate_mapnik_xml(self, layer_name, mml_file):
+        """Compile an MML file to Mapnik XML with magnacarto, or copy the result of
+        a previous compilation of the same inputs from the cache."""
         output_file = path.join(self.buildmap.temp_dir, layer_name + ".xml")
-        with open(output_file, "w") as fp:
-            fp.write(output)
+        cache_file = self.magnacarto_cache_dir() / (
+            self.magnacarto_cache_key(mml_file) + ".xml"
+        )
+        if cache_file.exists():
+            self.log.info("Using cached Mapnik XML for %s", layer_name)
+            shutil.copyfile(cache_file, output_file)
+            return output_file
+
+        start = time.time()
+        result = subprocess.run(["magnacarto", "-mml", mml_file], capture_output=True)
+        if result.returncode != 0:
+            raise Exception(
+                "magnacarto failed to compile %s (exit code %d): %s"
+                % (mml_file, result.returncode, result.stderr.decode().strip())
+            )
+        if result.stderr.strip():
+            self.log.warning(
+                "magnacarto output for %s: %s",
+                layer_name,
+                result.stderr.decode().strip(),
+            )
+        self.log.info(
+            "Compiled Mapnik XML for %s in %.2f seconds",
+            layer_name,
+            time.time() - start,
+        )
+
+        with open(output_file, "wb") as fp:
+            fp.write(result.stdout)
+
+        temp_file = cache_file.with_name(cache_file.name + ".%d.tmp" % os.getpid())
+        with open(temp_file, "wb") as fp:
+            fp.write(result.stdout)
+        os.replace(temp_file, cache_file)
 
         return output_file
 
@@ -202,29 +279,115 @@ class MapnikExporter(Exporter):
         with open(os.path.join(self.config["web_directory"], "config.json"), "w") as fp:
             json.dump(result, fp)
 
-    def preseed(self):
-        """Pre-generate tiles with Tilestache"""
+    def preseed_jobs(self, workers):
+        """Split preseeding into `(layer, zoom, bbox)` jobs. Each zoom level of each
+        layer is a job, and zoom levels which are wider than one tile are split
+        into up to `workers` tile-aligned strips, so they can be seeded concurrently.
+
+        `bbox` is in the (N, E, S, W) order used by the rest of this exporter.
+        """
+        w, s, e, n = self.buildmap.get_bbox().bounds
+        jobs = []
+        for zoom in range(
+            self.config["zoom_range"][0], self.config["zoom_range"][1] + 1
+        ):
+            min_x, _ = lonlat_to_tile(w, n, zoom)
+            max_x, _ = lonlat_to_tile(e, s, zoom)
+            columns = max_x - min_x + 1
+            strips = min(columns, workers)
+            for strip in range(strips):
+                first = min_x + strip * columns // strips
+                last = min_x + (strip + 1) * columns // strips - 1
+                # Clip the strip to the bbox, keeping it just inside the tile edges
+                # so the neighbouring tiles aren't seeded too.
+                strip_w = max(w, tile_to_lonlat(first, 0, zoom)[0] + 1e-9)
+                strip_e = min(e, tile_to_lonlat(last + 1, 0, zoom)[0] - 1e-9)
+                for layer in self.dest_layers:
+                    jobs.append((layer, zoom, (n, strip_e, s, strip_w)))
+        # Start with the biggest jobs
+        return sorted(jobs, key=lambda job: job[1], reverse=True)
+
+    def preseed(self, tiles=None):
+        """Pre-generate tiles with Tilestache.
+
+        This runs up to `preseed_workers` (default 1) tilestache-seed processes at
+        once, split by layer, zoom level and strips of tiles. If `tiles` is given as a
+        list of `(z, x, y)`, only those tiles are seeded.
+        """
         self.log.info("Preseeding layers %s", self.dest_layers.keys())
         for filename in ("tilestache-seed.py", "tilestache-seed"):
-            tilestache_seed = distutils.spawn.find_executable(filename)
+            tilestache_seed = shutil.which(filename)
             if tilestache_seed is not None:
                 break
+        else:
+            self.log.error("tilestache-seed not found, unable to preseed")
+            return
 
-        zoom_levels = [
-            str(l)
-            for l in range(
-                self.config["zoom_range"][0], self.config["zoom_range"][1] + 1
-            )
-        ]
-        for layer in self.dest_layers:
-            subprocess.call(
-                [tilestache_seed, "-x", "-b"]
-                + [str(c) for c in list(reversed(self.buildmap.get_bbox().bounds))]
+        workers = int(self.config.get("preseed_workers", 1))
+        if tiles is None:
+            jobs = [
+                (layer, zoom, ["-b"] + [str(c) for c in bbox])
+                for layer, zoom, bbox in self.preseed_jobs(workers)
+            ]
+        else:
+            jobs = []
+            for zoom in sorted(set(z for z, _, _ in tiles), reverse=True):
+                tile_list = path.join(
+                    self.buildmap.temp_dir, "tilestache_tiles_%d.txt" % zoom
+                )
+                with open(tile_list, "w") as fp:
+                    for z, x, y in tiles:
+                        if z == zoom:
+                            fp.write("%d/%d/%d\n" % (z, x, y))
+                for layer in self.dest_layers:
+                    jobs.append((layer, zoom, ["--tile-list", tile_list]))
+
+        def seed(job):
+            layer, zoom, area = job
+            start = time.time()
+            result = subprocess.run(
+                [tilestache_seed, "-x"]
+                + area
                 + [
                     "-c",
                     path.join(self.buildmap.temp_dir, "tilestache.json"),
                     "-l",
                     layer,
-                ]
-                + zoom_levels
+                    str(zoom),
+                ],
+                capture_output=True,
+                text=True,
             )
+            if result.returncode != 0:
+                self.log.error(
+                    "Seeding %s at zoom %d failed with exit code %d: %s",
+                    layer,
+                    zoom,
+                    result.returncode,
+                    result.stderr.strip()[-1000:],
+                )
+            return result.returncode, time.time() - start
+
+        start = time.time()
+        results = run_parallel(
+            seed,
+            jobs,
+            workers,
+            lambda job: "Seeding %s at zoom %d" % (job[0], job[1]),
+        )
+
+        timings = {}
+        failed = 0
+        for (layer, zoom, _), (returncode, elapsed) in zip(jobs, results):
+            timings[layer] = timings.get(layer, 0) + elapsed
+            if returncode != 0:
+                failed += 1
+        for layer, elapsed in sorted(timings.items()):
+            self.log.info("Seeded %s in %.2f seconds of worker time", layer, elapsed)
+        self.log.info(
+            "Preseeding complete in %.2f seconds, %d of %d jobs failed",
+            time.time() - start,
+            failed,
+            len(jobs),
+        )
+        return failed == 0
@@ -0,0 +1,236 @@
+import gzip
+import json
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+import sqlalchemy
+from sqlalchemy.sql import text
+from ..util import tile_width, tiles_in_bounds
+from . import Exporter
+from .tegola import TegolaExporter
+
+# MVT tile extent and buffer, in tile coordinates (these match Tegola's defaults)
+EXTENT = 4096
+BUFFER = 64
+
+# Tegola SQL tokens which can be used in custom layer queries
+SUPPORTED_TOKENS = {"!BBOX!", "!ZOOM!"}
+
+# The database engine for each worker process
+_engine = None
+
+
+def _init_worker(db_url):
+    global _engine
+    _engine = sqlalchemy.create_engine(db_url, pool_size=1)
+
+
+def _render_tiles(zoom, tiles, sql):
+    """Render a chunk of tiles at a zoom level, returning a list of
+    `(zoom, x, y, gzipped tile)` for the tiles which aren't empty."""
+    results = []
+    margin = tile_width(zoom) * BUFFER / EXTENT
+    with _engine.connect() as conn:
+        for x, y in tiles:
+            data = conn.execute(text(sql), z=zoom, x=x, y=y, margin=margin).scalar()
+            if data:
+                results.append((zoom, x, y, gzip.compress(bytes(data))))
+    return results
+
+
+class MBTilesExporter(Exporter):
+    """Render every vector tile in the map's bounding box and zoom range with PostGIS'
+    `ST_AsMVT`, and write them to an MBTiles file which can be served statically.
+
+    The layers, and their SQL, are the same as those served by Tegola (see
+    `TegolaExporter.get_layers`), including any `custom_layers`. Custom layers
+    which use Tegola tokens other than !BBOX! and !ZOOM! are left out.
+
+    Config (all optional), or `"mbtiles": true` for the defaults:
+
+        "mbtiles": {
+            "path": "buildmap.mbtiles",   # relative to web_directory
+            "workers": 4,                 # number of rendering processes
+            "chunk_size": 64              # tiles per task
+        }
+    """
+
+    def __init__(self, buildmap, config, db, tegola_exporter=None):
+        super().__init__(buildmap, config, db)
+        self.tegola = tegola_exporter
+
+    def export(self):
+        start_time = time.time()
+        opts = self.config.get("mbtiles")
+        opts = opts if isinstance(opts, dict) else {}
+        if self.tegola is None:
+            self.tegola = TegolaExporter(self.buildmap, self.config, self.db)
+            self.tegola.prepare_tables()
+
+        layers = list(self.tegola.get_layers())
+        custom_layers = self.custom_layers()
+        min_zoom, max_zoom = self.config["zoom_range"]
+        bounds = self.buildmap.get_bbox().bounds
+
+        dest = self.buildmap.resolve_path(self.config["web_directory"]) / opts.get(
+            "path", "buildmap.mbtiles"
+        )
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        temp = dest.with_name(dest.name + ".tmp")
+        if temp.exists():
+            temp.unlink()
+
+        out = sqlite3.connect(str(temp))
+        out.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        out.execute(
+            """CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER,
+                                   tile_row INTEGER, tile_data BLOB)"""
+        )
+        out.executemany(
+            "INSERT INTO metadata (name, value) VALUES (?, ?)",
+            self.metadata(layers, custom_layers, bounds).items(),
+        )
+
+        chunk_size = int(opts.get("chunk_size", 64))
+        tasks = []
+        for zoom in range(min_zoom, max_zoom + 1):
+            sql = self.tile_sql(zoom, layers, custom_layers)
+            tiles = list(tiles_in_bounds(bounds, zoom))
+            for i in range(0, len(tiles), chunk_size):
+                tasks.append((zoom, tiles[i : i + chunk_size], sql))
+
+        self.log.info(
+            "Rendering %d tiles from zoom %d to %d...",
+            sum(len(task[1]) for task in tasks),
+            min_zoom,
+            max_zoom,
+        )
+        count = 0
+        with ProcessPoolExecutor(
+            max_workers=int(opts.get("workers", os.cpu_count())),
+            initializer=_init_worker,
+            initargs=(self.db.url.render_as_string(hide_password=False),),
+        ) as executor:
+            for done, results in enumerate(
+                executor.map(_render_tiles, *zip(*tasks)) if tasks else []
+            ):
+                out.executemany(
+                    """INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data)
+                        VALUES (?, ?, ?, ?)""",
+                    # MBTiles uses TMS tile numbering, with the origin at the bottom
+                    [(z, x, 2**z - 1 - y, data) for z, x, y, data in results],
+                )
+                count += len(results)
+                if (done + 1) % 100 == 0:
+                    self.log.info(
+                        "Rendered %d of %d chunks (%d tiles)",
+                        done + 1,
+                        len(tasks),
+                        count,
+                    )
+
+        out.execute(
+            "CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)"
+        )
+        out.commit()
+        out.close()
+        os.replace(temp, dest)
+        self.log.info(
+            "Wrote %d tiles to %s in %.2f seconds",
+            count,
+            dest,
+            time.time() - start_time,
+        )
+
+    def custom_layers(self):
+        """Return `(name, sql)` for each of Tegola's `custom_layers` which can be
+        rendered here."""
+        result = []
+        for name, data in self.config.get("custom_layers", {}).items():
+            unsupported = (
+                set(re.findall(r"![A-Z_]+!", data["query"])) - SUPPORTED_TOKENS
+            )
+            if unsupported:
+                self.log.warning(
+                    "Custom layer %s uses unsupported tokens (%s), leaving it out",
+                    name,
+                    ", ".join(sorted(unsupported)),
+                )
+                continue
+            result.append((name, data["query"].replace("!ZOOM!", ":z")))
+        return result
+
+    def tile_sql(self, zoom, layers, custom_layers=()):
+        """Return the SQL to render a tile at `zoom`, taking :x, :y and :margin.
+
+        Each layer is rendered with `ST_AsMVT`, and the results are concatenated,
+        which gives a valid tile with multiple layers.
+        """
+        layer_sql = [
+            (layer.name, layer.sql)
+            for layer in layers
+            if layer.min_zoom <= zoom <= layer.max_zoom
+        ]
+        layer_sql.append(("bounding_box", TegolaExporter.BOUNDING_BOX_SQL))
+        layer_sql += custom_layers
+
+        bbox = "ST_Expand(ST_TileEnvelope(:z, :x, :y), :margin)"
+        parts = []
+        for name, sql in layer_sql:
+            # The layer SQL returns the geometry as WKB, and any other columns
+            # become feature properties.
+            parts.append(
+                """COALESCE((SELECT ST_AsMVT(tile, '{name}', {extent}, 'geom', 'gid') FROM (
+                    SELECT t.gid,
+                        ST_AsMVTGeom(ST_GeomFromWKB(t.geom, 3857), ST_TileEnvelope(:z, :x, :y),
+                            {extent}, {buffer}, true) AS geom,
+                        to_jsonb(t) - 'gid' - 'geom' AS properties
+                    FROM ({sql}) AS t
+                ) AS tile WHERE tile.geom IS NOT NULL), ''::bytea)""".format(
+                    name=name,
+                    extent=EXTENT,
+                    buffer=BUFFER,
+                    sql=sql.replace("!BBOX!", bbox),
+                )
+            )
+        return "SELECT " + " || ".join(parts)
+
+    def metadata(self, layers, custom_layers, bounds):
+        min_zoom, max_zoom = self.config["zoom_range"]
+        vector_layers = {}
+        for layer in layers:
+            if layer.name in vector_layers:
+                vector_layers[layer.name]["minzoom"] = min(
+                    vector_layers[layer.name]["minzoom"], layer.min_zoom
+                )
+                vector_layers[layer.name]["maxzoom"] = max(
+                    vector_layers[layer.name]["maxzoom"], layer.max_zoom
+                )
+            else:
+                vector_layers[layer.name] = {
+                    "id": layer.name,
+                    "fields": {},
+                    "minzoom": layer.min_zoom,
+                    "maxzoom": layer.max_zoom,
+                }
+        for name in ["bounding_box"] + [name for name, _ in custom_layers]:
+            vector_layers[name] = {
+                "id": name,
+                "fields": {},
+                "minzoom": min_zoom,
+                "maxzoom": max_zoom,
+            }
+
+        center = self.buildmap.get_center()
+        return {
+            "name": "buildmap",
+            "format": "pbf",
+            "type": "overlay",
+            "bounds": ",".join(str(b) for b in bounds),
+            "center": "%s,%s,%d" % (center[0], center[1], min_zoom),
+            "minzoom": str(min_zoom),
+            "maxzoom": str(max_zoom),
+            "json": json.dumps({"vector_layers": list(vector_layers.values())}),
+        }
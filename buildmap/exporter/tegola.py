@@ -1,12 +1,36 @@
 import toml
 import re
+import shutil
+import subprocess
+import threading
+import time
+from collections import namedtuple
 from os import path
-from ..util import sanitise_layer
+from shapely.geometry import box
+from ..util import (
+    run_parallel,
+    sanitise_layer,
+    tile_bounds,
+    tiles_in_bounds,
+    zoom_resolution,
+)
 from . import Exporter
 
-
-def strip_srid(srid):
-    return int(srid.replace("epsg:", ""))
+# A provider layer, which is served as the map layer `name` between `min_zoom`
+# and `max_zoom`. There may be several provider layers with the same name, each
+# covering a different zoom band.
+TileLayer = namedtuple(
+    "TileLayer",
+    [
+        "table",
+        "name",
+        "provider_layer",
+        "geometry_type",
+        "sql",
+        "min_zoom",
+        "max_zoom",
+    ],
+)
 
 
 type_mapping = {
@@ -16,6 +40,13 @@ type_mapping = {
 }
 
 
+def geometry_type_name(geometry_type):
+    """Return the Tegola geometry type name for a PostGIS geometry type
+    (e.g. 'ST_MultiLineString' -> 'linestring')"""
+    typename = geometry_type.split("_")[1].lower()
+    return type_mapping.get(typename, typename)
+
+
 class TegolaExporter(Exporter):
     """Generate config for Tegola, which is a Mapbox Vector Tiles server.
 
@@ -26,17 +57,144 @@ class TegolaExporter(Exporter):
     """
 
     PROVIDER_NAME = "buildmap"
+    MAP_NAME = "buildmap"
+    CACHE_BASEPATH = "/tmp/tegola"
+    # Number of tiles given to each `tegola cache seed` process when preseeding
+    PRESEED_CHUNK_SIZE = 500
+    # Database connections which Tegola may open. Preseeding processes share this
+    # between them, so they don't exhaust the server's connections.
+    MAX_CONNECTIONS = 20
     # Tegola only supports Web Mercator (3857) and WGS84 (4326), so we
     # need to transform from our working CRS, which is not likely to be one of those.
     SRID = 3857
 
+    def __init__(self, buildmap, config, db):
+        super().__init__(buildmap, config, db)
+        # (table name, geometry type name) -> materialised table name
+        self.materialised = {}
+        # (table name, geometry type name) -> [(min zoom, max zoom, table name)]
+        self.generalised = {}
+
+    # The bounding box of the map, which is in EPSG:4326 in the DB with a projected
+    # copy in geom_3857.
+    BOUNDING_BOX_SQL = """SELECT id AS gid, ST_AsBinary(geom_3857) AS geom
+                        FROM bounding_box
+                        WHERE geom_3857 && !BBOX!"""
+
     def export(self):
+        self.prepare_tables()
         dest_file = path.join(self.buildmap.temp_dir, "tegola.toml")
         with open(dest_file, "w") as fp:
             toml.dump(self.generate_tegola_config(), fp)
 
+    def preseed_tiles(self):
+        """Yield `(z, x, y)` for each tile in the zoom range which intersects the
+        bounding box of the map."""
+        bbox = self.buildmap.get_bbox()
+        for zoom in range(
+            self.config["zoom_range"][0], self.config["zoom_range"][1] + 1
+        ):
+            for x, y in tiles_in_bounds(bbox.bounds, zoom):
+                if bbox.intersects(box(*tile_bounds(x, y, zoom))):
+                    yield zoom, x, y
+
+    def preseed(self, tiles=None):
+        """Fill Tegola's cache by running `tegola cache seed` on lists of tiles.
+
+        `tiles` is a list of `(z, x, y)` to seed, defaulting to `preseed_tiles()`.
+        Up to `preseed_workers` (default 1) Tegola processes run at once. They use a
+        copy of the config which splits `MAX_CONNECTIONS` database connections
+        between them.
+        """
+        tegola = shutil.which("tegola")
+        if tegola is None:
+            self.log.error("tegola not found, unable to preseed")
+            return
+
+        workers = int(self.config.get("preseed_workers", 1))
+        seed_config = path.join(self.buildmap.temp_dir, "tegola_seed.toml")
+        with open(seed_config, "w") as fp:
+            toml.dump(
+                self.generate_tegola_config(max(1, self.MAX_CONNECTIONS // workers)),
+                fp,
+            )
+
+        if tiles is None:
+            tiles = list(self.preseed_tiles())
+        chunks = [
+            tiles[i : i + self.PRESEED_CHUNK_SIZE]
+            for i in range(0, len(tiles), self.PRESEED_CHUNK_SIZE)
+        ]
+        self.log.info(
+            "Preseeding %d tiles in %d chunks with %d workers",
+            len(tiles),
+            len(chunks),
+            workers,
+        )
+
+        start = time.time()
+        progress = {"tiles": 0, "failed": 0}
+        lock = threading.Lock()
+
+        def seed(chunk):
+            index, chunk_tiles = chunk
+            tile_list = path.join(self.buildmap.temp_dir, "tegola_tiles_%d.txt" % index)
+            with open(tile_list, "w") as fp:
+                for z, x, y in chunk_tiles:
+                    fp.write("%d/%d/%d\n" % (z, x, y))
+
+            result = subprocess.run(
+                [
+                    tegola,
+                    "cache",
+                    "seed",
+                    "tile-list",
+                    tile_list,
+                    "--config",
+                    seed_config,
+                    "--map",
+                    self.MAP_NAME,
+                    "--overwrite",
+                ],
+                capture_output=True,
+                text=True,
+            )
+            with lock:
+                progress["tiles"] += len(chunk_tiles)
+                if result.returncode != 0:
+                    progress["failed"] += 1
+                    self.log.error(
+                        "Seeding %s failed with exit code %d: %s",
+                        tile_list,
+                        result.returncode,
+                        result.stderr.strip(),
+                    )
+                elapsed = time.time() - start
+                self.log.info(
+                    "Seeded %d/%d tiles (%.1f tiles/s)",
+                    progress["tiles"],
+                    len(tiles),
+                    progress["tiles"] / elapsed if elapsed else 0,
+                )
+
+        run_parallel(
+            seed,
+            list(enumerate(chunks)),
+            workers,
+            lambda chunk: "Seeding chunk %d" % chunk[0],
+        )
+        elapsed = time.time() - start
+        self.log.info(
+            "Preseeded %d tiles in %.2f seconds (%.1f tiles/s), %d of %d chunks failed",
+            len(tiles),
+            elapsed,
+            len(tiles) / elapsed if elapsed else 0,
+            progress["failed"],
+            len(chunks),
+        )
+
     def get_layers(self):
-        """Generate `(tablename, layername, type, sql)` for each layer we want to render.
+        """Generate a `TileLayer` for each layer we want to render.
 
         MVT/Tegola only supports layers with a single geometry type, whereas DXF will
         happily let you have layers with multiple types. We output a layer per
@@ -45,39 +203,151 @@ class TegolaExporter(Exporter):
         source = self.buildmap.get_source_layers()
         seen = set()
         for table_name, layer_name in reversed(source):
-            # the get_layer_type function will return all the component types of a GeometryCollection.
+            # the layer catalog includes all the component types of a GeometryCollection.
             # We can handle those in get_layer_sql
-            types = self.db.get_layer_type(table_name, layer_name)
+            types = self.buildmap.get_layer_catalog(table_name)[
+                layer_name
+            ].geometry_types
             if len(types) == 1:
-                typename = types[0].split("_")[1].lower()
-                typename = type_mapping.get(typename, typename)
+                typename = geometry_type_name(types[0])
                 layer_name_typ = layer_name + "_" + typename
                 if sanitise_layer(layer_name_typ) in seen:
                     continue
                 seen.add(sanitise_layer(layer_name_typ))
-                yield (
-                    table_name,
-                    layer_name_typ,
-                    typename,
-                    self.get_layer_sql(table_name, layer_name, types[0]),
+                yield from self.get_zoom_bands(
+                    table_name, layer_name, layer_name_typ, types[0]
                 )
             else:
                 # Multiple simple types. Split them into different layers.
                 for typ in types:
-                    typename = typ.split("_")[1].lower()
-                    typename = type_mapping.get(typename, typename)
+                    typename = geometry_type_name(typ)
                     layer_name_typ = layer_name + "_" + typename
                     if sanitise_layer(layer_name_typ) in seen:
                         continue
                     seen.add(sanitise_layer(layer_name_typ))
-                    yield (
-                        table_name,
-                        layer_name_typ,
-                        typename,
-                        self.get_layer_sql(table_name, layer_name, typ),
+                    yield from self.get_zoom_bands(
+                        table_name, layer_name, layer_name_typ, typ
                     )
 
-    def generate_tegola_config(self):
+    def get_zoom_bands(self, table_name, layer_name, layer_name_typ, geometry_type):
+        """Yield a `TileLayer` for each generalised zoom band of a layer, followed by
+        one which serves the full resolution geometry at the remaining zoom levels."""
+        name = sanitise_layer(layer_name_typ)
+        typename = geometry_type_name(geometry_type)
+        min_zoom, max_zoom = self.config["zoom_range"]
+        for band_min, band_max, band_table in self.generalised.get(
+            (table_name, typename), []
+        ):
+            yield TileLayer(
+                table_name,
+                name,
+                "%s_z%d_%d" % (name, band_min, band_max),
+                typename,
+                self.get_materialised_layer_sql(
+                    table_name, band_table, layer_name, geometry_type
+                ),
+                band_min,
+                band_max,
+            )
+            min_zoom = band_max + 1
+
+        if min_zoom <= max_zoom:
+            yield TileLayer(
+                table_name,
+                name,
+                name,
+                typename,
+                self.get_layer_sql(table_name, layer_name, geometry_type),
+                min_zoom,
+                max_zoom,
+            )
+
+    def prepare_tables(self):
+        """Build any materialised or generalised tables which the layer SQL should
+        select from, as configured in `mapbox_vector_layer`."""
+        layer_config = self.config.get("mapbox_vector_layer")
+        if not isinstance(layer_config, dict):
+            layer_config = {}
+        # Check the bands before doing anything expensive
+        bands = self.generalise_bands(layer_config.get("generalise") or [])
+        # Generalised tables are built from the materialised tables
+        if layer_config.get("materialise", False) or bands:
+            self.materialise_tables()
+        if bands:
+            self.generalise_tables(bands)
+
+    def generalise_bands(self, bands):
+        """Check the `generalise` zoom bands from the config, and return them as a
+        sorted list of `(min zoom, max zoom)`, clamped to the map's zoom range.
+
+        The bands must be contiguous and must not overlap, starting at the map's
+        minimum zoom, as each zoom level needs exactly one version of each layer.
+        Zoom levels above the last band use the full resolution geometry.
+        """
+        min_zoom, max_zoom = self.config["zoom_range"]
+        result = []
+        for band in sorted(tuple(band) for band in bands):
+            band_min, band_max = max(band[0], min_zoom), min(band[1], max_zoom)
+            if band_min > band_max:
+                self.log.warning(
+                    "Generalise band %s is outside the zoom range, ignoring", list(band)
+                )
+                continue
+            expected = result[-1][1] + 1 if result else min_zoom
+            if band_min < expected:
+                raise ValueError(
+                    "Generalise band %s overlaps the previous band" % list(band)
+                )
+            if band_min > expected:
+                raise ValueError(
+                    "Generalise bands leave zoom levels %d to %d without a band"
+                    % (expected, band_min - 1)
+                )
+            result.append((band_min, band_max))
+        return result
+
+    def materialise_tables(self):
+        """Copy each geometry type used by a source layer into its own table, so
+        that tile queries don't have to extract them from the whole table."""
+        needed = set()
+        for table_name, layer_name in self.buildmap.get_source_layers():
+            for typ in self.buildmap.get_layer_catalog(table_name)[
+                layer_name
+            ].geometry_types:
+                typename = geometry_type_name(typ)
+                if typename in self.db.GEOMETRY_TYPES:
+                    needed.add((table_name, typename))
+
+        for table_name, typename in sorted(needed):
+            self.materialised[
+                (table_name, typename)
+            ] = self.db.materialise_geometry_type(
+                table_name, typename, self.buildmap.known_attributes[table_name]
+            )
+
+    def generalise_tables(self, bands):
+        """Build simplified copies of each materialised table for each zoom band.
+
+        `bands` is a list of `(min zoom, max zoom)` pairs from `generalise_bands`.
+        Geometries are simplified to the size of a pixel at the highest zoom of the
+        band, and features smaller than a pixel are dropped.
+        """
+        for (table_name, typename), materialised in sorted(self.materialised.items()):
+            self.generalised[(table_name, typename)] = [
+                (
+                    band_min,
+                    band_max,
+                    self.db.generalise_table(
+                        materialised,
+                        "%s_z%d_%d" % (materialised, band_min, band_max),
+                        typename,
+                        zoom_resolution(band_max),
+                    ),
+                )
+                for band_min, band_max in bands
+            ]
+
+    def generate_tegola_config(self, max_connections=MAX_CONNECTIONS):
         provider = {
             "name": self.PROVIDER_NAME,
             "type": "postgis",
@@ -87,23 +357,23 @@ class TegolaExporter(Exporter):
             "user": self.db.url.username,
             "password": self.db.url.password or "",
             "srid": self.SRID,
-            "max_connections": 20,
+            "max_connections": max_connections,
             "layers": [],
         }
 
         layers = list(self.get_layers())
 
-        for table_name, layer_name, typename, sql in layers:
+        for layer in layers:
             provider["layers"].append(
                 {
-                    "name": sanitise_layer(layer_name),
-                    "sql": sql,
-                    "geometry_type": typename,
+                    "name": layer.provider_layer,
+                    "sql": layer.sql,
+                    "geometry_type": layer.geometry_type,
                 }
             )
 
         m = {
-            "name": "buildmap",
+            "name": self.MAP_NAME,
             # Apply a 0.5 degree buffer to bounds Tegola is allowed to serve.
             # This restricts the amount of empty tiles will cache while allowing some margin.
             "bounds": list(self.buildmap.get_bbox().buffer(0.5).bounds),
@@ -117,27 +387,22 @@ class TegolaExporter(Exporter):
         ):
             m["attribution"] = self.config["mapbox_vector_layer"]["attribution"]
 
-        for table_name, layer_name, _, _ in layers:
+        for layer in layers:
             m["layers"].append(
                 {
+                    "name": layer.name,
                     "provider_layer": "%s.%s"
-                    % (self.PROVIDER_NAME, sanitise_layer(layer_name)),
-                    "min_zoom": self.config["zoom_range"][0],
-                    "max_zoom": self.config["zoom_range"][1],
+                    % (self.PROVIDER_NAME, layer.provider_layer),
+                    "min_zoom": layer.min_zoom,
+                    "max_zoom": layer.max_zoom,
                 }
             )
 
-        # Add bounding box layer to config. Bounding box in DB is in EPSG:4326
+        # Add bounding box layer to config.
         provider["layers"].append(
             {
                 "name": "bounding_box",
-                "sql": """SELECT id AS gid,
-                        ST_AsBinary(ST_Transform(wkb_geometry, {out_proj})) AS geom
-                        FROM bounding_box
-                        WHERE wkb_geometry && ST_Transform(!BBOX!, 4326)
-                   """.format(
-                    out_proj=self.SRID
-                ),
+                "sql": self.BOUNDING_BOX_SQL,
                 "geometry_type": "Polygon",
             }
         )
@@ -168,7 +433,7 @@ class TegolaExporter(Exporter):
 
         # Construct config
         data = {
-            "cache": {"type": "file", "basepath": "/tmp/tegola"},
+            "cache": {"type": "file", "basepath": self.CACHE_BASEPATH},
             "providers": [provider],
             "maps": [m],
         }
@@ -187,6 +452,14 @@ class TegolaExporter(Exporter):
         We'll extract entities of the specified type from any ST_GeometryCollections
         (which are generated from DXF blocks).
         """
+        materialised = self.materialised.get(
+            (table_name, geometry_type_name(geometry_type))
+        )
+        if materialised:
+            return self.get_materialised_layer_sql(
+                table_name, materialised, layer_name, geometry_type
+            )
+
         geom_field = "wkb_geometry"
         fid_field = "ogc_fid"
         additional_fields = list(self.buildmap.known_attributes[table_name])
@@ -199,7 +472,9 @@ class TegolaExporter(Exporter):
 
         # Return all table entries, plus the contents of all GeometryCollections.
         query = "(SELECT {fields} FROM {table}".format(
-            fields=", ".join([geom_field, fid_field, "layer"] + additional_fields),
+            fields=", ".join(
+                [geom_field, "geom_3857", fid_field, "layer"] + additional_fields
+            ),
             table=table_name,
         )
         query += " UNION ALL "
@@ -208,6 +483,7 @@ class TegolaExporter(Exporter):
         # map objects and DXF objects. ST_CollectionExtract will return MultiGeometries (which MVT does
         # support).
         query += """SELECT ST_CollectionExtract({geom_field}, {geom_type}) AS {geom_field},
+                    ST_CollectionExtract(geom_3857, {geom_type}) AS geom_3857,
                     {fields} FROM {table}
                     WHERE ST_GeometryType({geom_field}) = 'ST_GeometryCollection'""".format(
             geom_field=geom_field,
@@ -231,19 +507,19 @@ class TegolaExporter(Exporter):
                 "round(ST_Area(%s)::numeric, 1) AS area" % geom_field
             )
 
+        # Geometries are already projected into geom_3857 by
+        # `MapDB.add_projected_column`, but lengths and areas are measured in the
+        # source CRS.
         sql = """SELECT %s AS gid,
-                         ST_AsBinary(ST_Transform(%s, %s)) AS geom,
+                         ST_AsBinary(geom_3857) AS geom,
                          %s
                   FROM %s
                   WHERE layer = '%s'
-                  AND wkb_geometry && ST_Transform(!BBOX!, %s) """ % (
+                  AND geom_3857 && !BBOX! """ % (
             fid_field,
-            geom_field,
-            self.SRID,
             ", ".join(additional_fields),
             table_name,
             layer_name,
-            strip_srid(self.config["source_projection"]),
         )
 
         # Filter the result by the type of geometry we're looking for, taking into account MultiGeometries.
@@ -263,3 +539,28 @@ class TegolaExporter(Exporter):
         sql = re.sub(r"\s+", " ", sql)
 
         return sql
+
+    def get_materialised_layer_sql(
+        self, table_name, materialised, layer_name, geometry_type
+    ):
+        """Generate the SQL for a layer from a table created by
+        `MapDB.materialise_geometry_type`, which only contains the geometry type
+        we want, and already has the derived fields."""
+        fields = list(self.buildmap.known_attributes[table_name])
+        typename = geometry_type_name(geometry_type)
+        if typename == "linestring":
+            fields.append("length")
+        elif typename == "polygon":
+            fields += ["perimeter", "area"]
+
+        sql = """SELECT ogc_fid AS gid,
+                        ST_AsBinary(geom_3857) AS geom,
+                        %s
+                 FROM %s
+                 WHERE layer = '%s'
+                 AND geom_3857 && !BBOX!""" % (
+            ", ".join(fields),
+            materialised,
+            layer_name,
+        )
+        return re.sub(r"\s+", " ", sql)
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import sys
 import logging
@@ -16,8 +17,10 @@ from shapely.geometry import MultiPolygon, Polygon
 from pathlib import Path
 from mergedeep import merge
 
-from .util import sanitise_layer, build_options
+from .util import sanitise_layer, build_options, run_parallel
 from .mapdb import MapDB
+from .querystats import QueryStats
+from .profiler import Profiler
 from .input import Input
 from . import plugins  # noqa
 
@@ -30,7 +33,11 @@ def run():
 
 
 class BuildMap(object):
-    def __init__(self):
+    # Bump this when the transformations in `transform_table` change, to invalidate
+    # any tables cached by the import cache.
+    IMPORT_CACHE_VERSION = 4
+
+    def __init__(self, argv=None):
         self.log = logging.getLogger(self.__class__.__name__)
         parser = argparse.ArgumentParser(description="Mapping workflow processor")
         parser.add_argument(
@@ -52,6 +59,14 @@ class BuildMap(object):
             metavar="NAME",
             help="Choose which raster layer to export statically",
         )
+        parser.add_argument(
+            "--profile",
+            dest="profile",
+            action="store_true",
+            help="""Profile each stage of the build, writing a Chrome trace to
+                                    profile.json and statistics for each SQL statement
+                                    to query_report.json in the output directory""",
+        )
         parser.add_argument(
             "config",
             nargs="+",
@@ -59,16 +74,27 @@ class BuildMap(object):
                                   relative paths in all config files are resolved relative to the
                                   path of the first file.""",
         )
-        self.args = parser.parse_args()
+        self.args = parser.parse_args(argv)
 
         self.config = self.load_config(self.args.config)
-        self.db = MapDB(self.config["db_url"])
+        self.db = MapDB(
+            self.config["db_url"],
+            max(
+                5,
+                int(self.config.get("transform_workers", 1)) + 1,
+                int(self.config.get("geojson_workers", 1)) + 1,
+            ),
+        )
+        self.query_stats = QueryStats(self.config.get("explain_threshold"))
+        self.profiler = Profiler(self.args.profile, self.query_stats)
         self.bbox = None
 
         # Resolve any relative paths with respect to the first config file
         self.base_path = Path(self.args.config[0]).absolute().parent
         self.temp_dir = self.resolve_path(self.config["output_directory"])
         self.known_attributes = defaultdict(set)
+        self.index_layers = defaultdict(set)
+        self.layer_catalog = {}
         shutil.rmtree(self.temp_dir, True)
         self.temp_dir.mkdir(parents=True, exist_ok=True)
 
@@ -85,9 +111,8 @@ class BuildMap(object):
     def resolve_path(self, path: Union[str, Path]) -> Path:
         return self.base_path / path
 
-    def import_file(self, input_file: Input):
-        """Import a geo file into Postgres into the specified table name, overwriting the existing table."""
-
+    def ogr_options(self, input_file: Input) -> dict:
+        """Return the ogr2ogr options used to import a file."""
         ogr_opts = {
             "-t_srs": self.config["source_projection"],
             "-nln": input_file.table,
@@ -104,9 +129,13 @@ class BuildMap(object):
             ]
             ogr_opts["-sql"] = "SELECT *, OGR_STYLE FROM entities"
 
+        return ogr_opts
+
+    def import_file(self, input_file: Input, capture_output: bool = False):
+        """Import a geo file into Postgres into the specified table name, overwriting the existing table."""
         command = (
             ["ogr2ogr"]
-            + list(build_options(ogr_opts))
+            + list(build_options(self.ogr_options(input_file)))
             + [
                 f"PG:{self.db.url.render_as_string(False)}?application_name=buildmap",
                 input_file.path,
@@ -116,11 +145,86 @@ class BuildMap(object):
         self.log.info(
             "Importing %s into PostGIS table %s...", input_file.path, input_file.table
         )
+        start_time = time.time()
         try:
-            subprocess.check_call(command)
+            with self.profiler.stage(input_file.table, "import"):
+                self._run_ogr2ogr(command, input_file, capture_output)
         except OSError as e:
             self.log.error("Unable to run ogr2ogr: %s", e)
             sys.exit(1)
+        self.log.info(
+            "Imported %s in %.2f seconds", input_file.table, time.time() - start_time
+        )
+
+    def _run_ogr2ogr(self, command: list, input_file: Input, capture_output: bool):
+        if capture_output:
+            # When several imports run at once their output would be interleaved on the
+            # console, so collect it and log it against the table name instead.
+            result = subprocess.run(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+            )
+            for line in result.stdout.splitlines():
+                self.log.info("[%s] %s", input_file.table, line)
+            result.check_returncode()
+        else:
+            subprocess.check_call(command)
+
+    def import_files(self, inputs: list[Input]):
+        """Import all source files into PostGIS.
+
+        ogr2ogr is mostly single-threaded, so if `import_workers` is set in the config,
+        up to that many files are imported at once. If any import fails, imports which
+        haven't started yet are cancelled and the error is raised.
+        """
+        workers = int(self.config.get("import_workers", 1))
+        if workers > 1 and len(inputs) > 1:
+            # Resolve paths (and download any remote files) up front, so that downloads
+            # don't race with each other in the worker threads.
+            for input_file in inputs:
+                input_file.path
+            self.log.info(
+                "Importing %d files with up to %d workers", len(inputs), workers
+            )
+
+        start_time = time.time()
+        run_parallel(
+            lambda input_file: self.import_file(input_file, workers > 1),
+            inputs,
+            workers,
+            lambda input_file: "Import of %s" % input_file.table,
+        )
+        self.log.info("All imports complete in %.2f seconds", time.time() - start_time)
+
+    def import_cache_key(self, input_file: Input) -> str:
+        """Return a hash of everything which affects the contents of an imported table:
+        the source file itself, its `source_file` config, the projection, the map
+        extents (which it's cropped to), the ogr2ogr options, and the settings which
+        change how it's transformed and indexed.
+        """
+        h = hashlib.sha256()
+        with open(input_file.path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b""):
+                h.update(chunk)
+        h.update(
+            json.dumps(
+                {
+                    "version": self.IMPORT_CACHE_VERSION,
+                    "config": input_file.config,
+                    "source_projection": self.config["source_projection"],
+                    "extents": self.config.get("extents"),
+                    "ogr_options": self.ogr_options(input_file),
+                    "table_rewrite": self.config.get("table_rewrite", False),
+                    "attribute_engine": self.config.get("attribute_engine", "python"),
+                    "index_layers": sorted(self.index_layers[input_file.table]),
+                },
+                sort_keys=True,
+                default=str,
+            ).encode("utf-8")
+        )
+        return h.hexdigest()
 
     def get_source_layers(self):
         """Get a list of source layers. Returns a list of (tablename, layername) tuples.
@@ -134,7 +238,7 @@ class BuildMap(object):
         for table_name, source_file in self.config["source_file"].items():
             layer_order = source_file.get("layers", {})
             rename_layers = source_file.get("rename_layers", {})
-            file_layers = self.db.get_layers(table_name)
+            file_layers = self.get_layer_catalog(table_name)
 
             for layer in layer_order:
                 layer = rename_layers.get(layer, layer)
@@ -144,7 +248,7 @@ class BuildMap(object):
 
         for table_name, source_file in self.config["source_file"].items():
             rename_layers = source_file.get("rename_layers", {})
-            file_layers = self.db.get_layers(table_name)
+            file_layers = self.get_layer_catalog(table_name)
             # If we're configured to auto-import layers, add layers without a
             # defined order to the bottom of the layer order stack
             if source_file.get("auto_import_layers", False):
@@ -156,6 +260,16 @@ class BuildMap(object):
 
         return results
 
+    def get_layer_catalog(self, table_name):
+        """Return a dict of layer name to `LayerInfo` for a table.
+
+        The catalog is built once per table, after the transformations have run,
+        so it shouldn't be used before then.
+        """
+        if table_name not in self.layer_catalog:
+            self.layer_catalog[table_name] = self.db.get_layer_catalog(table_name)
+        return self.layer_catalog[table_name]
+
     def get_bbox(self):
         """Return bounding box of the map, as a shapely Polygon in WGS84 coordinates.
 
@@ -184,6 +298,8 @@ class BuildMap(object):
     def run(self):
         if not self.db.connect():
             return
+        if self.profiler.enabled:
+            self.query_stats.attach(self.db.engine)
 
         start_time = time.time()
         self.log.info("Generating map...")
@@ -205,72 +321,118 @@ class BuildMap(object):
         for table, attrs in self.known_attributes.items():
             self.log.info("Known attributes for %s: %s", table, ", ".join(attrs))
 
+        if self.profiler.enabled:
+            self.query_stats.write_report(self.temp_dir / "query_report.json")
+            self.profiler.write_trace(self.temp_dir / "profile.json")
+            self.profiler.log_summary()
         self.log.info("Generation complete in %.2f seconds", time.time() - start_time)
 
+    def load_plugins(self):
+        """Import the configured plugins, returning a list of
+        `(name, plugin class, options)` tuples."""
+        result = []
+        for plugin, opts in self.config.get("plugins", {}).items():
+            try:
+                pluginmod = importlib.import_module("." + plugin, "buildmap.plugins")
+            except ImportError as e:
+                self.log.exception("Plugin %s not loaded: %s", plugin, e)
+                continue
+            plugincls = getattr(pluginmod, plugin.capitalize() + "Plugin")
+            result.append((plugin, plugincls, opts))
+        return result
+
     def build_map(self):
         inputs = [
             Input(self, table_name, conf)
             for table_name, conf in self.config["source_file"].items()
         ]
-        #  Import each source file into PostGIS
+        plugins = self.load_plugins()
+
+        # Layers listed in a source file's `index_layers` get their own partial
+        # spatial index.
         for input_file in inputs:
-            self.import_file(input_file)
+            self.index_layers[input_file.table] |= set(
+                input_file.config.get("index_layers", [])
+            )
+        # If the import cache is enabled, skip importing and transforming any tables
+        # whose source hasn't changed since the last run.
+        cache_keys = {}
+        cached = {}
+        if self.config.get("import_cache", False):
+            self.db.create_import_cache()
+            for input_file in inputs:
+                cache_keys[input_file.table] = self.import_cache_key(input_file)
+                entry = self.db.get_import_cache(input_file.table)
+                if (
+                    entry is not None
+                    and entry.cache_key == cache_keys[input_file.table]
+                ):
+                    cached[input_file.table] = entry
+                else:
+                    self.db.clear_import_cache(input_file.table)
+
+        #  Import each source file into PostGIS
+        self.import_files([i for i in inputs if i.table not in cached])
 
         self.log.info(
             "Map bounds (N, E, S, W): %s", list(reversed(self.get_bbox().bounds))
         )
 
-        source_srid = self.config["source_projection"].split(":")[1]
-
         # Do some data transformation on the PostGIS table
         self.log.info("Transforming data...")
         self.db.create_bounding_layer("bounding_box", self.get_bbox())
 
         for input_file in inputs:
-            # Remove entities which don't intersect the provided bounding box.
-            # If there's a manually-supplied bounding box this allows us to crop out stuff which we don't want,
-            # such as construction objects placed outside the map
-
-            # TODO: allow per-file bounding boxes here, as we may want to crop some inputs differently from others.
-            self.db.execute(
-                f"""DELETE FROM {input_file.table} WHERE
-                    NOT ST_Intersects(
-                        wkb_geometry,
-                        ST_Transform((SELECT wkb_geometry FROM bounding_box LIMIT 1), {source_srid})
-                    )"""
-            )
-            for layer in input_file.config.get("combine_lines", []):
-                self.db.combine_lines(input_file.table, layer)
-            if input_file.file_type == "dxf":
-                self.db.clean_dxf_table(input_file.table)
-            elif input_file.file_type == "geojson":
-                self.db.add_single_layer_column(input_file.table)
-            self.db.optimise_table(input_file.table)
-            if "handle_prefix" in input_file.config:
-                self.db.prefix_handles(
-                    input_file.table, input_file.config["handle_prefix"]
+            if input_file.table in cached:
+                self.log.info(
+                    "Source for %s is unchanged, using cached table", input_file.table
                 )
-            for layer in input_file.config.get("force_polygon", []):
-                self.db.force_polygon(input_file.table, layer)
-            for layer in input_file.config.get("smooth", []):
-                self.db.smooth(input_file.table, layer)
-            for layer_src, layer_dst in input_file.config.get(
-                "rename_layers", {}
-            ).items():
-                self.db.rename_layer(input_file.table, layer_src, layer_dst)
-            self.known_attributes[input_file.table] |= self.db.extract_attributes(
-                input_file
+                self.known_attributes[input_file.table] |= cached[
+                    input_file.table
+                ].attributes
+
+        # Each table is transformed independently, so if `transform_workers` is set,
+        # run the transforms for several tables at once, each on its own connection.
+        workers = int(self.config.get("transform_workers", 1))
+
+        def transform(input_file, db):
+            self.transform_table(input_file, db)
+            if input_file.table in cache_keys:
+                db.set_import_cache(
+                    input_file.table,
+                    cache_keys[input_file.table],
+                    self.known_attributes[input_file.table],
+                )
+
+        def transform_worker(input_file):
+            if workers > 1:
+                with self.db.worker() as db:
+                    transform(input_file, db)
+            else:
+                transform(input_file, self.db)
+
+        run_parallel(
+            transform_worker,
+            [i for i in inputs if i.table not in cached],
+            workers,
+            lambda input_file: "Transforming %s" % input_file.table,
+        )
+
+        for input_file in inputs:
+            with self.profiler.stage(input_file.table, "catalog"):
+                catalog = self.get_layer_catalog(input_file.table)
+            self.log.info(
+                "%s has %d layers, %d features, %d vertices",
+                input_file.table,
+                len(catalog),
+                sum(layer.feature_count for layer in catalog.values()),
+                sum(layer.vertex_count for layer in catalog.values()),
             )
 
-        for plugin, opts in self.config.get("plugins", {}).items():
-            try:
-                pluginmod = importlib.import_module("." + plugin, "buildmap.plugins")
-                self.log.info("Running plugin %s...", plugin)
-            except ImportError as e:
-                self.log.exception("Plugin %s not loaded: %s", plugin, e)
-                continue
-            plugincls = getattr(pluginmod, plugin.capitalize() + "Plugin")
-            plugincls(self, self.config, opts, self.db).run()
+        for plugin, plugincls, opts in plugins:
+            self.log.info("Running plugin %s...", plugin)
+            with self.profiler.stage(plugin, "plugin"):
+                plugincls(self, self.config, opts, self.db).run()
 
         # Exporters are imported on demand here, so that modules required by a
         # single exporter don't prevent buildmap from running if that exporter is
@@ -284,26 +446,117 @@ class BuildMap(object):
 
             exporters.append(GeoJSONExporter(self, self.config, self.db))
 
+        if (
+            "vector_layer" in self.config
+            and self.config.get("flatgeobuf", False) is not False
+        ):
+            from .exporter.flatgeobuf import FlatGeobufExporter
+
+            exporters.append(FlatGeobufExporter(self, self.config, self.db))
+
         if "raster_layer" in self.config:
             from .exporter.mapnik import MapnikExporter
 
             mapnik_exporter = MapnikExporter(self, self.config, self.db)
             exporters.append(mapnik_exporter)
 
+        tegola_exporter = None
         if "mapbox_vector_layer" in self.config:
             from .exporter.tegola import TegolaExporter
 
-            exporters.append(TegolaExporter(self, self.config, self.db))
+            tegola_exporter = TegolaExporter(self, self.config, self.db)
+            exporters.append(tegola_exporter)
+
+        # Optional exporters run if their key is present and not set to false
+        if self.config.get("mbtiles", False) is not False:
+            from .exporter.mbtiles import MBTilesExporter
+
+            # Reuse the Tegola exporter's materialised tables, if there is one
+            exporters.append(
+                MBTilesExporter(self, self.config, self.db, tegola_exporter)
+            )
 
         self.log.info(
             "Exporting with: %s", ",".join(e.__class__.__name__ for e in exporters)
         )
 
         for exporter in exporters:
-            exporter.export()
+            with self.profiler.stage(exporter.__class__.__name__, "export"):
+                exporter.export()
+
+        if self.config.get("invalidate_tiles"):
+            from .tilecache import TileInvalidator
+
+            with self.profiler.stage("TileInvalidator", "invalidate"):
+                TileInvalidator(self, self.config, self.db).run(
+                    tegola_exporter, mapnik_exporter
+                )
 
         if self.args.preseed and mapnik_exporter is not None:
-            mapnik_exporter.preseed()
+            with self.profiler.stage("MapnikExporter", "preseed"):
+                mapnik_exporter.preseed()
+        if self.args.preseed and tegola_exporter is not None:
+            with self.profiler.stage("TegolaExporter", "preseed"):
+                tegola_exporter.preseed()
+
+    def transform_table(self, input_file: Input, db: MapDB):
+        """Run the data transformations for an imported table, using the connection
+        in `db`."""
+        source_srid = self.config["source_projection"].split(":")[1]
+        table = input_file.table
+
+        def step(name):
+            return self.profiler.stage(name, "transform", table=table)
+
+        # Remove entities which don't intersect the provided bounding box.
+        # If there's a manually-supplied bounding box this allows us to crop out stuff which we don't want,
+        # such as construction objects placed outside the map
+
+        # TODO: allow per-file bounding boxes here, as we may want to crop some inputs differently from others.
+        with step("crop %s" % table):
+            db.execute(
+                f"""DELETE FROM {table} WHERE
+                    NOT ST_Intersects(
+                        wkb_geometry,
+                        ST_Transform((SELECT wkb_geometry FROM bounding_box LIMIT 1), {source_srid})
+                    )"""
+            )
+        for layer in input_file.config.get("combine_lines", []):
+            with step("combine_lines %s %s" % (table, layer)):
+                db.combine_lines(table, layer)
+        if input_file.file_type == "dxf":
+            with step("clean_dxf_table %s" % table):
+                db.clean_dxf_table(table, self.config.get("table_rewrite", False))
+            with step("parse_text_styles %s" % table):
+                self.known_attributes[table] |= db.parse_text_styles(table)
+        elif input_file.file_type == "geojson":
+            with step("add_single_layer_column %s" % table):
+                db.add_single_layer_column(table)
+        # Extract attributes before any of the other updates, as this drops the raw
+        # DXF attribute data.
+        with step("extract_attributes %s" % table):
+            self.known_attributes[table] |= db.extract_attributes(
+                input_file, self.config.get("attribute_engine", "python")
+            )
+        if "handle_prefix" in input_file.config:
+            with step("prefix_handles %s" % table):
+                db.prefix_handles(table, input_file.config["handle_prefix"])
+        for layer in input_file.config.get("force_polygon", []):
+            with step("force_polygon %s %s" % (table, layer)):
+                db.force_polygon(table, layer)
+        for layer in input_file.config.get("smooth", []):
+            with step("smooth %s %s" % (table, layer)):
+                db.smooth(table, layer)
+        with step("rename_layers %s" % table):
+            for layer_src, layer_dst in input_file.config.get(
+                "rename_layers", {}
+            ).items():
+                db.rename_layer(table, layer_src, layer_dst)
+        with step("add_projected_column %s" % table):
+            db.add_projected_column(table, 3857)
+        # Index once the layers have their final names, and vacuum after all the updates
+        with step("optimise_table %s" % table):
+            db.optimise_table(table, self.index_layers[table])
 
     def generate_static(self, dest_layers):
         from .static import StaticExporter
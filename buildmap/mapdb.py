@@ -1,14 +1,39 @@
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+import io
+from contextlib import contextmanager
 import logging
 import sqlalchemy
 import re
+import time
 from time import sleep
 from shapely import wkt
 from sqlalchemy.sql import text
 
 from buildmap.input import Input
 
-from .dxfutils import parse_attributes
+from .dxfutils import parse_attributes, text_style_properties
+from .util import sanitise_layer
+
+ImportCacheEntry = namedtuple("ImportCacheEntry", ["cache_key", "attributes"])
+
+# Summary of a layer in a table. `geometry_types` includes the types of the contents
+# of any GeometryCollections, and `extent` is (minx, miny, maxx, maxy) in the table's SRS.
+LayerInfo = namedtuple(
+    "LayerInfo",
+    ["name", "geometry_types", "feature_count", "vertex_count", "extent"],
+)
+
+
+def _copy_value(value):
+    """Escape a value for COPY's text format."""
+    if value is None:
+        return "\\N"
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
 
 
 class MapDB(object):
@@ -23,19 +48,49 @@ class MapDB(object):
     MTEXT_FORMAT_REGEX = r"(\\[A-Za-z]([A-Za-z0-9\.\|]+;))*"
     # Regex to match inline formatting which looks like {\fArial|b0|i0|c0|p34;TEXT}
     INLINE_FORMAT_REGEX = r"{\\f.*;([^;]+)}"
+    # Regex to match unicode escapes in the format "\U+00f6"
+    UNICODE_ESCAPE_REGEX = r"\\U\+([0-9a-f]{4})"
+
+    # Distance (in source CRS units) within which line endpoints are joined by combine_lines
+    COMBINE_TOLERANCE = 1
+
+    # Table used to record the source file hashes of imported tables
+    IMPORT_CACHE_TABLE = "buildmap_import_cache"
+
+    # Tables used to record what was in the previous build, to find changed tiles
+    SNAPSHOT_TABLE = "buildmap_feature_snapshot"
+    TILE_STATE_TABLE = "buildmap_tile_state"
+
+    # Geometry types which can be materialised into their own table, with the
+    # PostGIS types they include and their ST_CollectionExtract type number.
+    GEOMETRY_TYPES = {
+        "point": (["ST_Point", "ST_MultiPoint"], 1),
+        "linestring": (["ST_LineString", "ST_MultiLineString"], 2),
+        "polygon": (["ST_Polygon", "ST_MultiPolygon"], 3),
+    }
 
-    def __init__(self, url):
+    # Columns added by parse_text_styles, and their types
+    TEXT_STYLE_COLUMNS = {
+        "text_size": "DOUBLE PRECISION",
+        "text_rotation": "DOUBLE PRECISION",
+        "text_font": "TEXT",
+        "text_colour": "TEXT",
+    }
+
+    def __init__(self, url, pool_size=5):
         self.log = logging.getLogger(self.__class__.__name__)
         self.url = sqlalchemy.engine.url.make_url(url)
+        self.pool_size = pool_size
+        self.engine = None
 
     def connect(self):
-        engine = sqlalchemy.create_engine(self.url)
+        self.engine = sqlalchemy.create_engine(self.url, pool_size=self.pool_size)
 
         # Retry connection indefinitely, to aid running in Docker
         connected = False
         while not connected:
             try:
-                self.conn = engine.connect()
+                self.conn = self.engine.connect()
                 connected = True
             except sqlalchemy.exc.OperationalError as e:
                 self.log.error(
@@ -59,12 +114,214 @@ class MapDB(object):
         self.log.info("Connected to PostGIS database %s", self.url)
         return True
 
-    def extract_attributes(self, input_file: Input) -> set[str]:
-        """Extract all the attributes for a table, returning them as a set."""
+    @contextmanager
+    def worker(self):
+        """Return a MapDB which uses its own connection from this MapDB's pool, so
+        it can be used from another thread."""
+        db = MapDB(self.url, self.pool_size)
+        db.engine = self.engine
+        db.conn = self.engine.connect()
+        try:
+            yield db
+        finally:
+            db.conn.close()
+
+    def create_import_cache(self):
+        """Create the table which records the source of each imported table."""
+        with self.conn.begin():
+            self.conn.execute(
+                text(
+                    """CREATE TABLE IF NOT EXISTS %s (
+                        table_name TEXT PRIMARY KEY,
+                        cache_key TEXT NOT NULL,
+                        attributes TEXT[] NOT NULL,
+                        imported_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now())"""
+                    % self.IMPORT_CACHE_TABLE
+                )
+            )
+
+    def get_import_cache(self, table_name):
+        """Return the ImportCacheEntry for a table, or None if the table isn't cached
+        or no longer exists."""
+        row = self.conn.execute(
+            text(
+                """SELECT cache_key, attributes FROM %s
+                    WHERE table_name = :table_name AND to_regclass(:table_name) IS NOT NULL"""
+                % self.IMPORT_CACHE_TABLE
+            ),
+            table_name=table_name,
+        ).first()
+        if row is None:
+            return None
+        return ImportCacheEntry(row[0], set(row[1]))
+
+    def set_import_cache(self, table_name, cache_key, attributes):
+        with self.conn.begin():
+            self.conn.execute(
+                text(
+                    """INSERT INTO %s (table_name, cache_key, attributes)
+                        VALUES (:table_name, :cache_key, :attributes)
+                        ON CONFLICT (table_name) DO UPDATE SET cache_key = excluded.cache_key,
+                            attributes = excluded.attributes,
+                            imported_at = now()"""
+                    % self.IMPORT_CACHE_TABLE
+                ),
+                table_name=table_name,
+                cache_key=cache_key,
+                attributes=sorted(attributes),
+            )
+
+    def clear_import_cache(self, table_name):
+        with self.conn.begin():
+            self.conn.execute(
+                text(
+                    "DELETE FROM %s WHERE table_name = :table_name"
+                    % self.IMPORT_CACHE_TABLE
+                ),
+                table_name=table_name,
+            )
+
+    def create_snapshot_tables(self):
+        """Create the tables which record the features and renderer config of the
+        previous build."""
+        with self.conn.begin():
+            self.conn.execute(
+                text(
+                    """CREATE TABLE IF NOT EXISTS %s (
+                        table_name TEXT NOT NULL,
+                        feature_key TEXT NOT NULL,
+                        geom_hash TEXT NOT NULL,
+                        attr_hash TEXT NOT NULL,
+                        extent geometry(Geometry, 3857),
+                        PRIMARY KEY (table_name, feature_key))"""
+                    % self.SNAPSHOT_TABLE
+                )
+            )
+            self.conn.execute(
+                text(
+                    "CREATE TABLE IF NOT EXISTS %s (name TEXT PRIMARY KEY, hash TEXT NOT NULL)"
+                    % self.TILE_STATE_TABLE
+                )
+            )
+
+    def diff_snapshot(self, table_name):
+        """Compare the features in a table to the snapshot saved by the previous
+        build, and return the Web Mercator extents, as `(xmin, ymin, xmax, ymax)`,
+        of every feature which has been added, removed or changed. Returns None if
+        there's no previous snapshot.
+
+        Features are identified by entity handle where there is one. Call
+        `save_snapshot` afterwards to replace the snapshot.
+        """
+        columns = self.get_columns(table_name)
+        key = next(c for c in ("entityhandle", "ogc_fid", "id") if c in columns)
+        new_snapshot = "buildmap_snapshot_%s" % table_name
+        with self.conn.begin():
+            self.conn.execute(text("DROP TABLE IF EXISTS %s" % new_snapshot))
+            self.conn.execute(
+                text(
+                    """CREATE TEMP TABLE {new_snapshot} AS
+                        SELECT feature_key,
+                            md5(string_agg(geom_hash, ',' ORDER BY geom_hash)) AS geom_hash,
+                            md5(string_agg(attr_hash, ',' ORDER BY attr_hash)) AS attr_hash,
+                            ST_SetSRID(ST_Extent(geom_3857)::geometry, 3857) AS extent
+                        FROM (
+                            SELECT {key}::text AS feature_key,
+                                md5(ST_AsBinary(wkb_geometry)) AS geom_hash,
+                                md5((to_jsonb(t) - 'ogc_fid' - 'wkb_geometry' - 'geom_3857')::text)
+                                    AS attr_hash,
+                                geom_3857
+                            FROM {table} AS t
+                        ) AS features
+                        GROUP BY feature_key""".format(
+                        new_snapshot=new_snapshot, key=key, table=table_name
+                    )
+                )
+            )
+
+        previous = self.conn.execute(
+            text(
+                "SELECT EXISTS (SELECT 1 FROM %s WHERE table_name = :table_name)"
+                % self.SNAPSHOT_TABLE
+            ),
+            table_name=table_name,
+        ).scalar()
+        if not previous:
+            return None
+
+        result = self.conn.execute(
+            text(
+                """SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+                FROM (
+                    SELECT new.extent FROM {new_snapshot} AS new
+                        LEFT JOIN {snapshot} AS old
+                            ON old.table_name = :table_name AND old.feature_key = new.feature_key
+                        WHERE old.feature_key IS NULL
+                            OR old.geom_hash != new.geom_hash OR old.attr_hash != new.attr_hash
+                    UNION ALL
+                    SELECT old.extent FROM {snapshot} AS old
+                        LEFT JOIN {new_snapshot} AS new ON old.feature_key = new.feature_key
+                        WHERE old.table_name = :table_name
+                            AND (new.feature_key IS NULL
+                                OR old.geom_hash != new.geom_hash OR old.attr_hash != new.attr_hash)
+                ) AS changes
+                WHERE extent IS NOT NULL""".format(
+                    snapshot=self.SNAPSHOT_TABLE, new_snapshot=new_snapshot
+                )
+            ),
+            table_name=table_name,
+        )
+        return [tuple(row) for row in result]
+
+    def save_snapshot(self, table_name):
+        """Replace the saved snapshot of a table with the one made by `diff_snapshot`."""
+        new_snapshot = "buildmap_snapshot_%s" % table_name
+        with self.conn.begin():
+            self.conn.execute(
+                text(
+                    "DELETE FROM %s WHERE table_name = :table_name"
+                    % self.SNAPSHOT_TABLE
+                ),
+                table_name=table_name,
+            )
+            self.conn.execute(
+                text(
+                    """INSERT INTO %s (table_name, feature_key, geom_hash, attr_hash, extent)
+                        SELECT :table_name, feature_key, geom_hash, attr_hash, extent
+                        FROM %s"""
+                    % (self.SNAPSHOT_TABLE, new_snapshot)
+                ),
+                table_name=table_name,
+            )
+            self.conn.execute(text("DROP TABLE %s" % new_snapshot))
+
+    def get_tile_state(self, name):
+        return self.conn.execute(
+            text("SELECT hash FROM %s WHERE name = :name" % self.TILE_STATE_TABLE),
+            name=name,
+        ).scalar()
+
+    def set_tile_state(self, name, value):
+        with self.conn.begin():
+            self.conn.execute(
+                text(
+                    """INSERT INTO %s (name, hash) VALUES (:name, :hash)
+                        ON CONFLICT (name) DO UPDATE SET hash = EXCLUDED.hash"""
+                    % self.TILE_STATE_TABLE
+                ),
+                name=name,
+                hash=value,
+            )
+
+    def extract_attributes(self, input_file: Input, engine="python") -> set[str]:
+        """Extract all the attributes for a table, returning them as a set.
+
+        `engine` selects how DXF attributes are parsed - see `extract_dxf_attributes`.
+        """
         if input_file.file_type == "dxf":
             # DXF files require special treatment
             with self.conn.begin():
-                return self.extract_dxf_attributes(input_file.table)
+                return self.extract_dxf_attributes(input_file.table, engine)
         else:
             # Just get all the columns and remove the ones we don't want
             res = set(
@@ -79,14 +336,51 @@ class MapDB(object):
             res -= {"ogc_fid", "wkb_geometry", "layer"}
             return res
 
-    def extract_dxf_attributes(self, table_name):
+    def extract_dxf_attributes(self, table_name, engine="python"):
         """Extract the DXF's XDATA attributes into individual columns, and
             return a set of all attribute column names.
 
         We use GDAL's "DXF_INCLUDE_RAW_CODE_VALUES" option which includes
         the raw values of any unparsed attributes in the `rawcodevalues` column,
-        which is an array.
+        which is an array. With the "python" engine these are parsed by
+        `dxfutils.parse_attributes`; with the "sql" engine the same parsing is done
+        in the database, so no row data is transferred.
+
+        The `rawcodevalues` column is dropped once the attributes are extracted.
         """
+        if engine == "python":
+            known_attributes = self._parse_dxf_attributes_python(table_name)
+        elif engine == "sql":
+            known_attributes = self._parse_dxf_attributes_sql(table_name)
+        else:
+            raise ValueError("Unknown attribute engine %s" % engine)
+
+        # Drop the raw values before updating the table, so the new row versions
+        # don't carry them.
+        self.conn.execute(text("ALTER TABLE %s DROP COLUMN rawcodevalues" % table_name))
+
+        columns = sorted(known_attributes)
+        for attr_name in columns:
+            self.conn.execute(
+                text("ALTER TABLE %s ADD COLUMN %s TEXT" % (table_name, attr_name))
+            )
+
+        if len(columns) > 0:
+            self.conn.execute(
+                text(
+                    """UPDATE %s AS t SET %s FROM buildmap_attributes AS a
+                        WHERE t.ogc_fid = a.ogc_fid"""
+                    % (
+                        table_name,
+                        ", ".join("%s = a.%s" % (name, name) for name in columns),
+                    )
+                )
+            )
+        return known_attributes | {"text", "entityhandle"}
+
+    def _parse_dxf_attributes_python(self, table_name):
+        """Parse attributes with `parse_attributes` and load them into the
+        `buildmap_attributes` temporary table, returning the attribute names."""
         known_attributes = set()
         attributes = {}
         result = self.conn.execute(
@@ -101,22 +395,154 @@ class MapDB(object):
             attributes[fid] = attrs
             known_attributes.update(attrs.keys())
 
-        for attr_name in known_attributes:
-            self.conn.execute(
-                text("ALTER TABLE %s ADD COLUMN %s TEXT" % (table_name, attr_name))
-            )
+        if len(known_attributes) == 0:
+            return known_attributes
 
+        # Send all the attribute values to the database in one go with COPY, rather
+        # than issuing one UPDATE per attribute per entity.
+        columns = sorted(known_attributes)
+        self.conn.execute(
+            text(
+                """CREATE TEMPORARY TABLE buildmap_attributes (
+                        ogc_fid INTEGER PRIMARY KEY, %s
+                    ) ON COMMIT DROP"""
+                % ", ".join("%s TEXT" % name for name in columns)
+            )
+        )
+        data = io.StringIO()
         for ogc_fid, attrs in attributes.items():
-            for name, value in attrs.items():
+            if len(attrs) == 0:
+                continue
+            data.write(
+                "\t".join(
+                    [str(ogc_fid)] + [_copy_value(attrs.get(name)) for name in columns]
+                )
+                + "\n"
+            )
+        data.seek(0)
+        self.conn.connection.cursor().copy_expert(
+            "COPY buildmap_attributes FROM STDIN", data
+        )
+        return known_attributes
+
+    def _parse_dxf_attributes_sql(self, table_name):
+        """Parse attributes in the database into the `buildmap_attributes` temporary
+        table, returning the attribute names.
+
+        This mirrors `parse_attributes`: only "1000" codes containing a colon are
+        used, keys are lowercased, hyphens in values become spaces, and if a key
+        appears more than once the last value wins.
+        """
+        self.conn.execute(
+            text(
+                """CREATE TEMPORARY TABLE buildmap_raw_attributes ON COMMIT DROP AS
+                    SELECT ogc_fid, ord,
+                        lower(split_part(val, ':', 1)) AS name,
+                        replace(substr(val, strpos(val, ':') + 1), '-', ' ') AS value
+                    FROM (
+                        SELECT t.ogc_fid, r.ord, substr(r.code, 6) AS val
+                        FROM {table} AS t, unnest(t.rawcodevalues) WITH ORDINALITY AS r(code, ord)
+                        WHERE r.code LIKE '1000 %'
+                    ) AS raw
+                    WHERE strpos(val, ':') > 0""".format(
+                    table=table_name
+                )
+            )
+        )
+        known_attributes = set(
+            row[0]
+            for row in self.conn.execute(
+                text("SELECT DISTINCT name FROM buildmap_raw_attributes")
+            )
+        )
+
+        if len(known_attributes) == 0:
+            return known_attributes
+
+        columns = sorted(known_attributes)
+        self.conn.execute(
+            text(
+                """CREATE TEMPORARY TABLE buildmap_attributes ON COMMIT DROP AS
+                    SELECT ogc_fid, {columns} FROM buildmap_raw_attributes
+                    GROUP BY ogc_fid""".format(
+                    columns=", ".join(
+                        "(array_agg(value ORDER BY ord DESC) FILTER (WHERE name = '%s'))[1] AS %s"
+                        % (name.replace("'", "''"), name)
+                        for name in columns
+                    )
+                )
+            )
+        )
+        self.conn.execute(
+            text("ALTER TABLE buildmap_attributes ADD PRIMARY KEY (ogc_fid)")
+        )
+        return known_attributes
+
+    def parse_text_styles(self, table_name):
+        """Parse the OGR style strings of labels in a DXF table into the columns in
+        `TEXT_STYLE_COLUMNS`, returning their names.
+
+        The styles are parsed by `dxfutils.text_style_properties` in one pass, and
+        loaded back into the table with COPY, so exporters don't need to parse them.
+        """
+        columns = list(self.TEXT_STYLE_COLUMNS)
+        with self.conn.begin():
+            for name, column_type in self.TEXT_STYLE_COLUMNS.items():
                 self.conn.execute(
                     text(
-                        "UPDATE %s SET %s = :value WHERE ogc_fid = :fid"
-                        % (table_name, name.lower())
-                    ),
-                    value=value,
-                    fid=ogc_fid,
+                        "ALTER TABLE %s ADD COLUMN %s %s"
+                        % (table_name, name, column_type)
+                    )
                 )
-        return known_attributes | {"text", "entityhandle"}
+
+            result = self.conn.execute(
+                text(
+                    """SELECT ogc_fid, ogr_style FROM %s
+                        WHERE text IS NOT NULL AND ogr_style LIKE 'LABEL(%%'"""
+                    % table_name
+                )
+            )
+            data = io.StringIO()
+            for ogc_fid, ogr_style in result:
+                style = text_style_properties(ogr_style)
+                data.write(
+                    "\t".join(
+                        [str(ogc_fid)]
+                        + [
+                            _copy_value(None if value is None else str(value))
+                            for value in (style[name] for name in columns)
+                        ]
+                    )
+                    + "\n"
+                )
+            if data.tell() == 0:
+                return set(columns)
+
+            self.conn.execute(
+                text(
+                    """CREATE TEMPORARY TABLE buildmap_text_styles (
+                            ogc_fid INTEGER PRIMARY KEY, %s
+                        ) ON COMMIT DROP"""
+                    % ", ".join(
+                        "%s %s" % item for item in self.TEXT_STYLE_COLUMNS.items()
+                    )
+                )
+            )
+            data.seek(0)
+            self.conn.connection.cursor().copy_expert(
+                "COPY buildmap_text_styles FROM STDIN", data
+            )
+            self.conn.execute(
+                text(
+                    """UPDATE %s AS t SET %s FROM buildmap_text_styles AS s
+                        WHERE t.ogc_fid = s.ogc_fid"""
+                    % (
+                        table_name,
+                        ", ".join("%s = s.%s" % (name, name) for name in columns),
+                    )
+                )
+            )
+        return set(columns)
 
     def get_bounds(self, table_name, srs=4326):
         """Fetch the bounding box of all rows within a table."""
@@ -144,7 +570,9 @@ class MapDB(object):
                 text(
                     """CREATE TABLE "%s" (
                                         id SERIAL PRIMARY KEY,
-                                        wkb_geometry geometry(POLYGON, %s))
+                                        wkb_geometry geometry(POLYGON, %s),
+                                        geom_3857 geometry(POLYGON, 3857)
+                                            GENERATED ALWAYS AS (ST_Transform(wkb_geometry, 3857)) STORED)
                                    """
                     % (table_name, srid)
                 )
@@ -158,8 +586,16 @@ class MapDB(object):
                 )
             )
 
-    def clean_dxf_table(self, table_name):
-        """Tidy up some mess in Postgres which ogr2ogr makes when importing DXFs."""
+    def clean_dxf_table(self, table_name, rewrite=False):
+        """Tidy up some mess in Postgres which ogr2ogr makes when importing DXFs.
+
+        If `rewrite` is set, this is done by rewriting the table in a single pass
+        (see `rewrite_dxf_table`) rather than with a series of UPDATEs.
+        """
+        if rewrite:
+            self.rewrite_dxf_table(table_name)
+            return
+
         with self.conn.begin():
             # Fix newlines in labels and trim whitespace
             self.conn.execute(
@@ -203,15 +639,292 @@ class MapDB(object):
             )
             self.clean_weird_unicode(table_name)
 
-    def optimise_table(self, table_name):
+    def rewrite_dxf_table(self, table_name):
+        """Apply the same clean-up as `clean_dxf_table` with a single
+        `CREATE TABLE ... AS SELECT`, then swap the new table in for the old one.
+
+        Each UPDATE in `clean_dxf_table` writes a new version of every row, which
+        bloats the table and makes the following VACUUM expensive. This writes
+        each row once.
+        """
+        columns = self.get_columns(table_name)
+        new_table = table_name + "_clean"
+
+        # Keep the geometry column's type modifier (geometry type and SRID), which
+        # would otherwise be lost in the CREATE TABLE ... AS.
+        geom_type = self.conn.execute(
+            text(
+                """SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                    WHERE attrelid = CAST(:table_name AS regclass) AND attname = 'wkb_geometry'"""
+            ),
+            table_name=table_name,
+        ).scalar()
+
+        select = []
+        for column in columns:
+            if column == "subclasses":
+                # See clean_dxf_table
+                continue
+            elif column == "text":
+                select.append(self._unescape_unicode_sql("c.text") + " AS text")
+            elif column == "wkb_geometry":
+                select.append(
+                    """ST_ForceRHR(CASE
+                        WHEN ST_IsClosed(wkb_geometry)
+                            AND ST_GeometryType(wkb_geometry) = 'ST_LineString'
+                            AND ST_NumPoints(wkb_geometry) > 3
+                        THEN ST_MakePolygon(wkb_geometry)
+                        ELSE wkb_geometry END)::%s AS wkb_geometry"""
+                    % geom_type
+                )
+            else:
+                select.append('t."%s"' % column)
+
+        with self.conn.begin():
+            sequence = self.conn.execute(
+                text("SELECT pg_get_serial_sequence(:table_name, 'ogc_fid')"),
+                table_name=table_name,
+            ).scalar()
+            self.conn.execute(text("DROP TABLE IF EXISTS %s" % new_table))
+            self.conn.execute(
+                text(
+                    """CREATE TABLE {new_table} AS SELECT {select}
+                        FROM {table} AS t,
+                        LATERAL (SELECT regexp_replace(regexp_replace(
+                            NULLIF(trim(replace(t.text, '^J', '\n')), 'SOLID'),
+                            '{mtext}', ''), '{inline}', '\\1') AS text) AS c""".format(
+                        new_table=new_table,
+                        select=", ".join(select),
+                        table=table_name,
+                        mtext=self.MTEXT_FORMAT_REGEX,
+                        inline=self.INLINE_FORMAT_REGEX,
+                    )
+                )
+            )
+            if sequence is not None:
+                self.conn.execute(
+                    text(
+                        "ALTER SEQUENCE %s OWNED BY %s.ogc_fid" % (sequence, new_table)
+                    )
+                )
+            self.conn.execute(text("DROP TABLE %s" % table_name))
+            self.conn.execute(
+                text("ALTER TABLE %s RENAME TO %s" % (new_table, table_name))
+            )
+            if sequence is not None:
+                self.conn.execute(
+                    text(
+                        "ALTER TABLE %s ALTER COLUMN ogc_fid SET DEFAULT nextval('%s')"
+                        % (table_name, sequence)
+                    )
+                )
+            # The spatial index which ogr2ogr created is recreated by optimise_table.
+            self.conn.execute(
+                text("ALTER TABLE %s ADD PRIMARY KEY (ogc_fid)" % table_name)
+            )
+
+    def _unescape_unicode_sql(self, expr):
+        """Return an SQL expression which does the same as `clean_weird_unicode`
+        to the text expression `expr`."""
+        return """CASE WHEN {expr} ~ '{match}' THEN (
+                SELECT string_agg(
+                    part || COALESCE(chr(('x' || lpad(code, 8, '0'))::bit(32)::integer), ''),
+                    '' ORDER BY n)
+                FROM unnest(
+                    regexp_split_to_array({expr}, '{match}'),
+                    ARRAY(SELECT m[1] FROM regexp_matches({expr}, '{match}', 'g') AS m)
+                ) WITH ORDINALITY AS u(part, code, n)
+            ) ELSE {expr} END""".format(
+            expr=expr, match=self.UNICODE_ESCAPE_REGEX
+        )
+
+    def optimise_table(self, table_name, index_layers=()):
+        """Index a table and update its statistics.
+
+        As well as an index on layer, this creates a spatial index and an index on
+        layer and geometry type, which are what most exporters and plugins filter on.
+        Layers in `index_layers` get their own partial spatial index, for layers which
+        are queried spatially (for example, by plugins).
+        """
+        indexes = {
+            "%s_layer" % table_name: "(layer)",
+            # This is the name which ogr2ogr uses, so it may already exist.
+            "%s_wkb_geometry_geom_idx" % table_name: "USING GIST (wkb_geometry)",
+            "%s_layer_type" % table_name: "(layer, ST_GeometryType(wkb_geometry))",
+        }
+        for layer in index_layers:
+            name, definition = self._layer_index(table_name, layer)
+            indexes[name] = definition
+
+        with self.conn.begin():
+            for name, definition in indexes.items():
+                self.create_index(table_name, name, definition)
+        self.vacuum(table_name)
+
+    def vacuum(self, table_name):
+        """VACUUM ANALYZE a table.
+
+        VACUUM can't run in a transaction, and setting AUTOCOMMIT on `self.conn`
+        would leave its DBAPI connection in autocommit mode, so that later
+        transactions (and the ON COMMIT DROP temporary tables made in them) end
+        after each statement. Use a separate connection from the pool instead.
+        """
+        with self.engine.connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT").execute(
+                text("VACUUM ANALYZE %s" % table_name)
+            )
+
+    def _layer_index(self, table_name, layer):
+        """Return the name and definition of a partial spatial index on one layer."""
+        return (
+            "%s_%s_geom" % (table_name, sanitise_layer(layer)),
+            "USING GIST (wkb_geometry) WHERE layer = '%s'" % layer.replace("'", "''"),
+        )
+
+    def create_layer_index(self, table_name, layer):
+        """Create a partial spatial index on one layer of a table, for layers which
+        are only known once the table has been loaded."""
+        with self.conn.begin():
+            self.create_index(table_name, *self._layer_index(table_name, layer))
+
+    def create_index(self, table_name, index_name, definition):
+        """Create an index if it doesn't already exist, logging how long it took and
+        how big it is."""
+        start = time.time()
+        self.conn.execute(
+            text(
+                'CREATE INDEX IF NOT EXISTS "%s" ON %s %s'
+                % (index_name, table_name, definition)
+            )
+        )
+        size = self.conn.execute(
+            text("SELECT pg_size_pretty(pg_relation_size(CAST(:index AS regclass)))"),
+            index='"%s"' % index_name,
+        ).scalar()
+        self.log.info(
+            "Index %s built in %.2f seconds (%s)", index_name, time.time() - start, size
+        )
+
+    def add_projected_column(self, table_name, srid=3857):
+        """Add a spatially-indexed copy of the geometry, transformed to `srid`, in a
+        column named `geom_<srid>`, so that tile servers don't have to reproject every
+        feature on every request.
+
+        This is a generated column, so it stays in sync if the geometry is changed
+        later.
+        """
+        column = "geom_%s" % srid
+        with self.conn.begin():
+            self.conn.execute(
+                text(
+                    """ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} geometry(Geometry, {srid})
+                        GENERATED ALWAYS AS (ST_Transform(wkb_geometry, {srid})) STORED""".format(
+                        table=table_name, column=column, srid=srid
+                    )
+                )
+            )
+            self.create_index(
+                table_name,
+                "%s_%s_idx" % (table_name, column),
+                "USING GIST (%s)" % column,
+            )
+        return column
+
+    def materialise_geometry_type(self, table_name, geometry_type, columns):
+        """Copy the features of a single geometry type ("point", "linestring" or
+        "polygon") into their own indexed table, returning its name.
+
+        Matching parts are extracted from GeometryCollections (DXF blocks), so they
+        keep the ogc_fid of the block. Lines get a length column, and polygons get
+        perimeter and area columns. The source table must already have a geom_3857
+        column (see `add_projected_column`), which is the one that gets indexed.
+        """
+        dest = "%s_%s" % (table_name, geometry_type)
+        types, collection_type = self.GEOMETRY_TYPES[geometry_type]
+        fields = ", ".join(["ogc_fid", "layer"] + list(columns))
+        derived = {
+            "linestring": ", round(ST_Length(wkb_geometry)::numeric, 1) AS length",
+            "polygon": """, round(ST_Perimeter(wkb_geometry)::numeric, 1) AS perimeter,
+                round(ST_Area(wkb_geometry)::numeric, 1) AS area""",
+        }.get(geometry_type, "")
+
+        start = time.time()
+        with self.conn.begin():
+            self.conn.execute(text("DROP TABLE IF EXISTS %s" % dest))
+            self.conn.execute(
+                text(
+                    """CREATE TABLE {dest} AS
+                        SELECT {fields}, wkb_geometry, geom_3857{derived} FROM (
+                            SELECT {fields}, wkb_geometry, geom_3857 FROM {table}
+                                WHERE ST_GeometryType(wkb_geometry) IN ({types})
+                            UNION ALL
+                            SELECT {fields}, ST_CollectionExtract(wkb_geometry, {collection_type}),
+                                ST_CollectionExtract(geom_3857, {collection_type})
+                                FROM {table}
+                                WHERE ST_GeometryType(wkb_geometry) = 'ST_GeometryCollection'
+                        ) AS t
+                        WHERE NOT ST_IsEmpty(wkb_geometry)""".format(
+                        dest=dest,
+                        fields=fields,
+                        derived=derived,
+                        table=table_name,
+                        types=", ".join("'%s'" % t for t in types),
+                        collection_type=collection_type,
+                    )
+                )
+            )
+            self._index_tile_table(dest)
+        self.vacuum(dest)
+        self.log.info("Materialised %s in %.2f seconds", dest, time.time() - start)
+        return dest
+
+    def generalise_table(self, source, dest, geometry_type, tolerance):
+        """Copy a table created by `materialise_geometry_type`, simplifying geom_3857
+        with a tolerance of `tolerance` metres and dropping lines and polygons which
+        are smaller than that. Returns the name of the new table."""
+        columns = [
+            column
+            for column in self.get_columns(source)
+            if column not in ("wkb_geometry", "geom_3857")
+        ]
+        size_filter = {
+            "linestring": "WHERE ST_Length(geom_3857) >= %(tolerance)f",
+            "polygon": "WHERE ST_Area(geom_3857) >= %(tolerance)f * %(tolerance)f",
+        }.get(geometry_type, "") % {"tolerance": tolerance}
+
+        start = time.time()
         with self.conn.begin():
-            # Create layer index to speed up querying
+            self.conn.execute(text("DROP TABLE IF EXISTS %s" % dest))
             self.conn.execute(
-                text("CREATE INDEX %s_layer on %s(layer)" % (table_name, table_name))
+                text(
+                    """CREATE TABLE {dest} AS
+                        SELECT {columns}, geom_3857 FROM (
+                            SELECT {columns},
+                                ST_SimplifyPreserveTopology(geom_3857, {tolerance}) AS geom_3857
+                            FROM {source} {size_filter}
+                        ) AS t
+                        WHERE NOT ST_IsEmpty(geom_3857)""".format(
+                        dest=dest,
+                        columns=", ".join(columns),
+                        tolerance=tolerance,
+                        source=source,
+                        size_filter=size_filter,
+                    )
+                )
             )
-        self.conn.execution_options(isolation_level="AUTOCOMMIT").execute(
-            text("VACUUM ANALYZE %s" % table_name)
+            self._index_tile_table(dest)
+        self.vacuum(dest)
+        self.log.info(
+            "Generalised %s to %.2fm in %.2f seconds",
+            dest,
+            tolerance,
+            time.time() - start,
         )
+        return dest
+
+    def _index_tile_table(self, table_name):
+        self.create_index(table_name, "%s_geom" % table_name, "USING GIST (geom_3857)")
+        self.create_index(table_name, "%s_layer" % table_name, "(layer)")
 
     def add_single_layer_column(self, table_name):
         """Add a layer column containing the name of the table, to align single-layer
@@ -230,7 +943,7 @@ class MapDB(object):
         """Sometimes text comes through as strange unicode in the format "\\U+00f6".
         Probably AutoCAD's fault.
         """
-        MATCH_REGEX = r"\\U\+([0-9a-f]{4})"
+        MATCH_REGEX = self.UNICODE_ESCAPE_REGEX
         result = self.conn.execute(
             text("SELECT ogc_fid, text FROM {} WHERE text ~ :regex".format(table_name)),
             regex=MATCH_REGEX,
@@ -255,67 +968,104 @@ class MapDB(object):
                 )
             )
 
-    def get_layer_type(self, table_name, layer_name):
-        with self.conn.begin():
-            sql = """SELECT DISTINCT ST_GeometryType(geom) FROM (
-                        SELECT (ST_Dump(wkb_geometry)).geom AS geom
-                            FROM {table} WHERE layer = '{layer}'
-                            and st_geometrytype(wkb_geometry) = 'ST_GeometryCollection'
-                        UNION ALL SELECT wkb_geometry AS geom
-                            FROM {table} WHERE layer = '{layer}'
-                            AND st_geometrytype(wkb_geometry) != 'ST_GeometryCollection'
-                    ) AS t""".format(
-                table=table_name, layer=layer_name
-            )
-            result = self.conn.execute(text(sql))
-            return [row[0] for row in result]
-
     def combine_lines(self, table_name, layer_name):
         """Given a layer which contains linestrings which *almost* comprise
-        polygons, try and combine them."""
-        sets = []
+        polygons, try and combine them.
+
+        Lines are linked when any of their endpoints are within COMBINE_TOLERANCE
+        of each other. Linked lines are grouped with a union-find, and each group is
+        merged into the line with the lowest ID.
+        """
         with self.conn.begin():
-            sql = """SELECT a.ogc_fid, b.ogc_fid FROM {table} a, {table} b
-                        WHERE (ST_Touches(a.wkb_geometry, b.wkb_geometry)
-                            OR ST_StartPoint(a.wkb_geometry) && ST_Buffer(ST_EndPoint(b.wkb_geometry), 1)
-                            OR ST_EndPoint(a.wkb_geometry) && ST_Buffer(ST_StartPoint(b.wkb_geometry), 1)
-                        )
-                        AND ST_GeometryType(a.wkb_geometry) = 'ST_LineString'
-                        AND ST_GeometryType(b.wkb_geometry) = 'ST_LineString'
-                        AND a.layer = '{layer}' and b.layer = '{layer}'
-                        ORDER BY a.ogc_fid ASC""".format(
-                table=table_name, layer=layer_name
+            # Collect line endpoints into an indexed table so they can be joined with
+            # ST_DWithin, rather than comparing every pair of lines.
+            self.conn.execute(
+                text(
+                    """CREATE TEMPORARY TABLE buildmap_endpoints ON COMMIT DROP AS
+                        SELECT ogc_fid, ST_StartPoint(wkb_geometry) AS point FROM {table}
+                            WHERE layer = :layer AND ST_GeometryType(wkb_geometry) = 'ST_LineString'
+                        UNION ALL
+                        SELECT ogc_fid, ST_EndPoint(wkb_geometry) AS point FROM {table}
+                            WHERE layer = :layer AND ST_GeometryType(wkb_geometry) = 'ST_LineString'
+                    """.format(
+                        table=table_name
+                    )
+                ),
+                layer=layer_name,
             )
-            # Generate a number of sets of linked entities
-            for res in self.conn.execute(text(sql)):
-                for s in sets:
-                    if res[0] in s or res[1] in s:
-                        s.add(res[0])
-                        s.add(res[1])
-                        break
-                else:
-                    sets.append({res[0], res[1]})
-
-            for s in sets:
-                if len(s) == 1:
-                    # This is a single line, skip it
-                    continue
-
-                # Merge the all geometries into the one with the lowest ID
-                dest = min(s)
-                sql = """UPDATE {table} SET wkb_geometry = (SELECT ST_LineMerge(ST_Union(wkb_geometry))
-                       FROM {table} WHERE ogc_fid IN :fids) WHERE ogc_fid = :dest""".format(
-                    table=table_name
+            self.conn.execute(
+                text("CREATE INDEX ON buildmap_endpoints USING GIST (point)")
+            )
+            self.conn.execute(text("ANALYZE buildmap_endpoints"))
+            pairs = self.conn.execute(
+                text(
+                    """SELECT DISTINCT a.ogc_fid, b.ogc_fid
+                        FROM buildmap_endpoints AS a JOIN buildmap_endpoints AS b
+                        ON a.ogc_fid < b.ogc_fid AND ST_DWithin(a.point, b.point, :tolerance)"""
+                ),
+                tolerance=self.COMBINE_TOLERANCE,
+            )
+
+            # Union-find, where the root of each set is its lowest ID
+            parent = {}
+
+            def find(fid):
+                root = fid
+                while parent.setdefault(root, root) != root:
+                    root = parent[root]
+                while parent[fid] != root:
+                    parent[fid], fid = root, parent[fid]
+                return root
+
+            for a, b in pairs:
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+
+            if len(parent) == 0:
+                return
+
+            fids = list(parent.keys())
+            dests = [find(fid) for fid in fids]
+            self.log.info(
+                "Combining %d lines into %d in %s layer %s",
+                len(fids),
+                len(set(dests)),
+                table_name,
+                layer_name,
+            )
+
+            # Merge all the geometries in each set into the one with the lowest ID,
+            # and delete the rest.
+            self.conn.execute(
+                text(
+                    """CREATE TEMPORARY TABLE buildmap_merges ON COMMIT DROP AS
+                        SELECT * FROM unnest(CAST(:fids AS INTEGER[]), CAST(:dests AS INTEGER[]))
+                        AS m(ogc_fid, dest)"""
+                ),
+                fids=fids,
+                dests=dests,
+            )
+            self.conn.execute(
+                text(
+                    """UPDATE {table} AS t SET wkb_geometry = merged.geom FROM (
+                            SELECT m.dest, ST_LineMerge(ST_Union(l.wkb_geometry)) AS geom
+                            FROM {table} AS l JOIN buildmap_merges AS m ON l.ogc_fid = m.ogc_fid
+                            GROUP BY m.dest
+                        ) AS merged
+                        WHERE t.ogc_fid = merged.dest""".format(
+                        table=table_name
+                    )
                 )
-                self.conn.execute(text(sql), fids=tuple(s), dest=dest)
-                self.conn.execute(
-                    text(
-                        "DELETE FROM {table} WHERE ogc_fid IN :fids".format(
-                            table=table_name
-                        )
-                    ),
-                    fids=tuple(s - {dest}),
+            )
+            self.conn.execute(
+                text(
+                    """DELETE FROM {table} AS t USING buildmap_merges AS m
+                        WHERE t.ogc_fid = m.ogc_fid AND m.ogc_fid != m.dest""".format(
+                        table=table_name
+                    )
                 )
+            )
 
     def force_polygon(self, table_name, layer_name):
         """Force all linestring objects in a layer to be polygons by
@@ -336,16 +1086,48 @@ class MapDB(object):
             )
             self.conn.execute(text(sql))
 
-    def get_layers(self, table_name):
-        res = self.conn.execute(text("SELECT DISTINCT layer FROM %s" % table_name))
-        return [row[0] for row in res]
+    def get_layer_catalog(self, table_name):
+        """Summarise every layer in a table in a single pass, returning a dict of
+        layer name to LayerInfo."""
+        sql = """WITH features AS (
+                    SELECT layer, wkb_geometry,
+                        CASE WHEN ST_GeometryType(wkb_geometry) = 'ST_GeometryCollection'
+                            THEN ARRAY(SELECT DISTINCT ST_GeometryType(d.geom) FROM ST_Dump(wkb_geometry) AS d)
+                            ELSE ARRAY[ST_GeometryType(wkb_geometry)]
+                        END AS types
+                    FROM {table}
+                ), stats AS (
+                    SELECT layer, count(*) AS features, sum(ST_NPoints(wkb_geometry)) AS vertices,
+                        ST_Extent(wkb_geometry) AS extent
+                    FROM features GROUP BY layer
+                ), types AS (
+                    SELECT layer, array_agg(DISTINCT type) AS types
+                    FROM features, unnest(features.types) AS type
+                    WHERE type IS NOT NULL GROUP BY layer
+                )
+                SELECT s.layer, t.types, s.features, s.vertices,
+                    ST_XMin(s.extent), ST_YMin(s.extent), ST_XMax(s.extent), ST_YMax(s.extent)
+                FROM stats AS s LEFT JOIN types AS t ON s.layer IS NOT DISTINCT FROM t.layer""".format(
+            table=table_name
+        )
+        catalog = {}
+        for row in self.conn.execute(text(sql)):
+            catalog[row[0]] = LayerInfo(
+                row[0],
+                list(row[1] or []),
+                row[2],
+                int(row[3] or 0),
+                tuple(row[4:8]) if row[4] is not None else None,
+            )
+        return catalog
 
     def get_columns(self, table_name):
         """Return a list of columns for the given table"""
         result = self.conn.execute(
             text(
                 """SELECT column_name FROM information_schema.columns
-                    WHERE table_schema = 'public' AND table_name = :table"""
+                    WHERE table_schema = 'public' AND table_name = :table
+                    ORDER BY ordinal_position"""
             ),
             table=table_name,
         )
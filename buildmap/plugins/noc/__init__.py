@@ -135,17 +135,17 @@ class NocPlugin(object):
             + """ AS switch
                             FROM {table} AS edge, {table} AS switch
                             WHERE edge.ogc_fid=:edge_ogc_fid
-                            AND switch.layer = ANY(:switch_layers)
+                            AND switch.layer = :switch_layer
                             AND ST_GeometryType(switch.wkb_geometry) = 'ST_Point'
-                            AND ST_Buffer(switch.wkb_geometry, :buf) && ST_"""
+                            AND ST_DWithin(switch.wkb_geometry, ST_"""
             + start_or_end.title()
-            + """Point(edge.wkb_geometry)
+            + """Point(edge.wkb_geometry), :buf)
                             """
         )
         switch_result = self.db.execute(
             node_sql,
             edge_ogc_fid=edge_ogc_fid,
-            switch_layers=[self.location_layer],
+            switch_layer=self.location_layer,
             buf=self.BUFFER,
         )
         switch_rows = switch_result.fetchall()
@@ -629,6 +629,9 @@ class NocPlugin(object):
             self.location_layer,
             list(self.link_layers.keys()),
         )
+        # Each link looks up the switches at its ends, so index the switch layer.
+        # Its exact name is only known once the layers have been detected.
+        self.db.create_layer_index(self.table, self.location_layer)
 
         start = time.time()
         if not self.generate_plan():
@@ -38,7 +38,7 @@ class TranslatePlugin(object):
         trans_col = "text_{}".format(lang)
         self.db.execute(
             text(
-                "ALTER TABLE {table} ADD COLUMN {col} TEXT".format(
+                "ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {col} TEXT".format(
                     table=table, col=trans_col
                 )
             )
@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _child_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Profiler(object):
+    """Record wall time, CPU time, peak RSS and database time for each stage of
+    the build, and write them out as a Chrome trace (which can be loaded into
+    chrome://tracing, Perfetto or speedscope).
+
+    CPU time is that of the current thread, plus any subprocesses (such as ogr2ogr)
+    which finished during the stage. Peak RSS is the high-water mark of the
+    process at the end of the stage. DB time comes from `QueryStats`, and any time
+    it spends capturing query plans is left out of the stage's wall time.
+
+    When disabled, `stage` does nothing.
+    """
+
+    def __init__(self, enabled, query_stats=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.enabled = enabled
+        self.query_stats = query_stats
+        self.events = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def db_time(self):
+        if self.query_stats is None:
+            return 0.0
+        return self.query_stats.db_time
+
+    def explain_time(self):
+        if self.query_stats is None:
+            return 0.0
+        return self.query_stats.explain_time
+
+    @contextmanager
+    def stage(self, name, category, **args):
+        if not self.enabled:
+            yield
+            return
+
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        child_cpu = _child_cpu_time()
+        db = self.db_time()
+        explain = self.explain_time()
+        try:
+            yield
+        finally:
+            end = time.perf_counter() - (self.explain_time() - explain)
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (wall - self.start) * 1e6,
+                "dur": (end - wall) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": dict(
+                    args,
+                    wall_time=end - wall,
+                    cpu_time=time.thread_time() - cpu,
+                    child_cpu_time=_child_cpu_time() - child_cpu,
+                    db_time=self.db_time() - db,
+                    # ru_maxrss is in kilobytes on Linux
+                    peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                    / 1024,
+                ),
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def write_trace(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, "w") as fp:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
+        self.log.info("Profile trace written to %s", path)
+
+    def log_summary(self):
+        with self.lock:
+            events = sorted(
+                self.events, key=lambda e: e["args"]["wall_time"], reverse=True
+            )
+        self.log.info(
+            "%-60s %10s %10s %10s %10s %10s",
+            "Stage",
+            "Wall (s)",
+            "CPU (s)",
+            "Child (s)",
+            "DB (s)",
+            "RSS (MB)",
+        )
+        for event in events:
+            args = event["args"]
+            self.log.info(
+                "%-60.60s %10.2f %10.2f %10.2f %10.2f %10.1f",
+                "%s: %s" % (event["cat"], event["name"]),
+                args["wall_time"],
+                args["cpu_time"],
+                args["child_cpu_time"],
+                args["db_time"],
+                args["peak_rss_mb"],
+            )
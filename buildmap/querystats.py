@@ -0,0 +1,140 @@
+import json
+import logging
+import re
+import threading
+import time
+from sqlalchemy import event
+
+
+def fingerprint(statement: str) -> str:
+    """Normalise an SQL statement so that statements which only differ by their
+    literal values are counted together."""
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"\b\d+(\.\d+)?\b", "?", statement)
+    statement = re.sub(r"\s+", " ", statement).strip()
+    statement = re.sub(r"\(\?(, \?)+\)", "(?, ...)", statement)
+    return statement
+
+
+class QueryStats(object):
+    """Record statistics for every statement executed by an SQLAlchemy engine.
+
+    Statements are grouped by their fingerprint. If `explain_threshold` is set,
+    the plan of any SELECT which takes longer than that many seconds is captured
+    with `EXPLAIN (ANALYZE, BUFFERS)`. Note that this runs the statement again; the
+    time this takes isn't counted as DB time, and is recorded in `explain_time` so
+    the profiler can leave it out of its stage timings.
+    """
+
+    def __init__(self, explain_threshold=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.explain_threshold = explain_threshold
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        end = time.perf_counter()
+        elapsed = end - conn.info["query_start"].pop()
+        self.local.db_time = self.db_time + elapsed
+
+        key = fingerprint(statement)
+        with self.lock:
+            if key not in self.stats:
+                self.stats[key] = {
+                    "fingerprint": key,
+                    "calls": 0,
+                    "total_time": 0.0,
+                    "max_time": 0.0,
+                    "rows": 0,
+                    "explain": None,
+                }
+            stat = self.stats[key]
+            stat["calls"] += 1
+            stat["total_time"] += elapsed
+            stat["max_time"] = max(stat["max_time"], elapsed)
+            if cursor.rowcount > 0:
+                stat["rows"] += cursor.rowcount
+            explain = (
+                self.explain_threshold is not None
+                and elapsed >= self.explain_threshold
+                and stat["explain"] is None
+                and re.match(r"\s*SELECT\b", statement, re.IGNORECASE) is not None
+            )
+
+        if explain:
+            plan = self.explain(cursor.connection, statement, parameters)
+            self.local.explain_time = self.explain_time + time.perf_counter() - end
+            with self.lock:
+                stat["explain"] = plan
+
+    def explain(self, dbapi_conn, statement, parameters):
+        """Return the EXPLAIN (ANALYZE, BUFFERS) output for a statement. This is
+        run in a savepoint so a failure doesn't abort the current transaction."""
+        cursor = dbapi_conn.cursor()
+        try:
+            cursor.execute("SAVEPOINT buildmap_explain")
+            try:
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+                cursor.execute("RELEASE SAVEPOINT buildmap_explain")
+                return plan
+            except Exception:
+                cursor.execute("ROLLBACK TO SAVEPOINT buildmap_explain")
+                raise
+        except Exception as e:
+            self.log.debug("Unable to explain statement: %s", e)
+            return None
+        finally:
+            cursor.close()
+
+    @property
+    def db_time(self) -> float:
+        """Total time spent executing statements in the current thread."""
+        return getattr(self.local, "db_time", 0.0)
+
+    @property
+    def explain_time(self) -> float:
+        """Total time spent capturing plans in the current thread."""
+        return getattr(self.local, "explain_time", 0.0)
+
+    def report(self) -> list:
+        """Return the statistics for each statement, slowest first."""
+        with self.lock:
+            stats = [dict(stat) for stat in self.stats.values()]
+        for stat in stats:
+            stat["mean_time"] = stat["total_time"] / stat["calls"]
+        return sorted(stats, key=lambda s: s["total_time"], reverse=True)
+
+    def write_report(self, path):
+        report = self.report()
+        with open(path, "w") as fp:
+            json.dump(
+                {
+                    "total_time": sum(stat["total_time"] for stat in report),
+                    "calls": sum(stat["calls"] for stat in report),
+                    "statements": report,
+                },
+                fp,
+                indent=2,
+            )
+
+        self.log.info("Query report written to %s. Top statements:", path)
+        for stat in report[:5]:
+            self.log.info(
+                "\t%.2fs in %d calls: %.100s",
+                stat["total_time"],
+                stat["calls"],
+                stat["fingerprint"],
+            )
@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import os
+import shutil
+from pathlib import Path
+from .util import mercator_tiles
+
+
+def hash_files(paths):
+    digest = hashlib.sha256()
+    for path in sorted(str(p) for p in paths):
+        with open(path, "rb") as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+
+class TileInvalidator(object):
+    """Purge only the cached tiles which are affected by changes since the previous
+    build, rather than the whole cache.
+
+    Features in each source table (and the bounding box) are compared with a
+    snapshot saved by the previous build, by entity handle, geometry hash and
+    attribute hash. The tiles covering changed features, plus a margin of `margin`
+    tiles, are removed from the Tegola and TileStache caches. If a renderer's
+    configuration has changed, or there's no previous snapshot, its whole cache is
+    purged.
+
+    Config:
+
+        "invalidate_tiles": {
+            "margin": 1,       # extra tiles around each change, for labels and buffers
+            "reseed": false    # re-render purged tiles straight away
+        }
+    """
+
+    def __init__(self, buildmap, config, db):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.buildmap = buildmap
+        self.config = config
+        self.db = db
+        opts = config.get("invalidate_tiles")
+        self.opts = opts if isinstance(opts, dict) else {}
+
+    def run(self, tegola_exporter=None, mapnik_exporter=None):
+        self.db.create_snapshot_tables()
+        tables = list(self.config["source_file"].keys()) + ["bounding_box"]
+
+        tiles = self.changed_tiles(tables)
+
+        if tegola_exporter is not None:
+            self.invalidate(
+                "tegola",
+                [Path(self.buildmap.temp_dir) / "tegola.toml"],
+                tiles,
+                self.purge_tegola,
+                tegola_exporter.preseed,
+            )
+        if mapnik_exporter is not None:
+            self.invalidate(
+                "mapnik",
+                list(mapnik_exporter.dest_layers.values()),
+                tiles,
+                lambda tiles: self.purge_tilestache(mapnik_exporter, tiles),
+                mapnik_exporter.preseed,
+            )
+
+        # Only save the new snapshot once the caches have been purged
+        for table in tables:
+            self.db.save_snapshot(table)
+
+    def changed_tiles(self, tables):
+        """Return the set of `(z, x, y)` tiles affected by changes to `tables`, or
+        None if any of them have no previous snapshot."""
+        margin = int(self.opts.get("margin", 1))
+        extents = []
+        complete = True
+        for table in tables:
+            # Every table must be diffed, so its snapshot can be saved
+            changes = self.db.diff_snapshot(table)
+            if changes is None:
+                self.log.info("No previous snapshot of %s", table)
+                complete = False
+            else:
+                self.log.info("%d features changed in %s", len(changes), table)
+                extents += changes
+        if not complete:
+            return None
+
+        tiles = set()
+        for zoom in range(
+            self.config["zoom_range"][0], self.config["zoom_range"][1] + 1
+        ):
+            for extent in extents:
+                tiles.update(
+                    (zoom, x, y) for x, y in mercator_tiles(extent, zoom, margin)
+                )
+        self.log.info("%d tiles affected by changes", len(tiles))
+        return tiles
+
+    def invalidate(self, name, config_files, tiles, purge, reseed):
+        """Purge the changed tiles for a renderer, or all of them if its config
+        files have changed, and optionally reseed them."""
+        state = hash_files(config_files)
+        if self.db.get_tile_state(name) != state:
+            self.log.info("%s config has changed", name)
+            tiles = None
+
+        purge(tiles)
+        # --preseed will seed everything anyway
+        if (
+            self.opts.get("reseed", False)
+            and not self.buildmap.args.preseed
+            and (tiles is None or len(tiles) > 0)
+        ):
+            reseed(None if tiles is None else sorted(tiles))
+        self.db.set_tile_state(name, state)
+
+    def purge_tiles(self, cache_dir: Path, tiles, extension=""):
+        """Remove `z/x/y` files from a cache directory, or the whole directory if
+        `tiles` is None."""
+        if tiles is None:
+            self.log.info("Purging all tiles in %s", cache_dir)
+            shutil.rmtree(cache_dir, True)
+            return
+
+        removed = 0
+        for z, x, y in tiles:
+            try:
+                os.remove(cache_dir / str(z) / str(x) / (str(y) + extension))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        self.log.info("Purged %d cached tiles from %s", removed, cache_dir)
+
+    def purge_tegola(self, tiles):
+        from .exporter.tegola import TegolaExporter
+
+        self.purge_tiles(
+            Path(TegolaExporter.CACHE_BASEPATH) / TegolaExporter.MAP_NAME, tiles
+        )
+
+    def purge_tilestache(self, mapnik_exporter, tiles):
+        # The TileStache disk cache is configured with "portable" dirs, so tiles
+        # are stored as layer/z/x/y.png
+        for layer in mapnik_exporter.dest_layers:
+            self.purge_tiles(Path(self.config["tile_cache_dir"]) / layer, tiles, ".png")
@@ -1,4 +1,13 @@
+import logging
+import math
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+log = logging.getLogger(__name__)
+
+# Width of the world in Web Mercator metres
+WEB_MERCATOR_EXTENT = 2 * 20037508.342789244
+TILE_SIZE = 256
 
 
 def sanitise_layer(name):
@@ -8,6 +17,67 @@ def sanitise_layer(name):
     return name
 
 
+def zoom_resolution(zoom: int) -> float:
+    """Return the size of a pixel, in Web Mercator metres, at a zoom level"""
+    return WEB_MERCATOR_EXTENT / TILE_SIZE / 2**zoom
+
+
+def tile_width(zoom: int) -> float:
+    """Return the width of a tile, in Web Mercator metres, at a zoom level"""
+    return WEB_MERCATOR_EXTENT / 2**zoom
+
+
+def lonlat_to_tile(lon: float, lat: float, zoom: int) -> tuple[int, int]:
+    """Return the (x, y) XYZ tile containing a WGS84 coordinate"""
+    n = 2**zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tile_to_lonlat(x: int, y: int, zoom: int) -> tuple[float, float]:
+    """Return the WGS84 coordinate of the top left corner of an XYZ tile"""
+    n = 2**zoom
+    lon = x / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lon, lat
+
+
+def tile_bounds(x: int, y: int, zoom: int) -> tuple[float, float, float, float]:
+    """Return the WGS84 bounds of an XYZ tile as (W, S, E, N)"""
+    w, n = tile_to_lonlat(x, y, zoom)
+    e, s = tile_to_lonlat(x + 1, y + 1, zoom)
+    return w, s, e, n
+
+
+def tiles_in_bounds(bounds, zoom: int):
+    """Yield (x, y) for each XYZ tile at `zoom` which covers the WGS84 `bounds`,
+    given as (W, S, E, N) like shapely's `bounds`."""
+    w, s, e, n = bounds
+    min_x, min_y = lonlat_to_tile(w, n, zoom)
+    max_x, max_y = lonlat_to_tile(e, s, zoom)
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            yield x, y
+
+
+def mercator_tiles(extent, zoom: int, margin: int = 0):
+    """Yield (x, y) for each XYZ tile at `zoom` which covers a Web Mercator
+    `extent` of (xmin, ymin, xmax, ymax), plus `margin` tiles on each side."""
+    xmin, ymin, xmax, ymax = extent
+    width = tile_width(zoom)
+    origin = WEB_MERCATOR_EXTENT / 2
+    last = 2**zoom - 1
+    min_x = max(int((xmin + origin) // width) - margin, 0)
+    max_x = min(int((xmax + origin) // width) + margin, last)
+    min_y = max(int((origin - ymax) // width) - margin, 0)
+    max_y = min(int((origin - ymin) // width) + margin, last)
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            yield x, y
+
+
 def write_file(name, data):
     with open(name, "w") as fp:
         fp.write(data)
@@ -40,3 +110,31 @@ def build_options(options: dict) -> list[str]:
         else:
             yield k
             yield v
+
+
+def run_parallel(func, items: list, workers: int, describe=str) -> list:
+    """Call `func` on each of `items` using up to `workers` threads, and return
+    the results in the same order as `items`.
+
+    If any call raises an exception, calls which haven't started yet are cancelled
+    and the exception is re-raised. `describe` is used to name the failed item in
+    the log.
+    """
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {executor.submit(func, item): i for i, item in enumerate(items)}
+    try:
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                log.error(
+                    "%s failed, cancelling remaining tasks",
+                    describe(items[futures[future]]),
+                )
+                raise future.exception()
+            results[futures[future]] = future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return results
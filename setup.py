@@ -38,5 +38,6 @@ setup(
         "pylabels",
         "requests==2.31.0",
     ],
+    extras_require={"brotli": ["brotli"], "test": ["pytest"]},
     entry_points={"console_scripts": {"buildmap=buildmap.main:run"}},
 )
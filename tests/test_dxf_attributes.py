@@ -0,0 +1,126 @@
+"""Check that the "python" and "sql" engines of `MapDB.extract_dxf_attributes`
+produce identical tables.
+
+These tests need a PostgreSQL database (PostGIS isn't required), which may be
+overwritten. Set BUILDMAP_TEST_DB_URL to run them, e.g.
+
+    BUILDMAP_TEST_DB_URL=postgresql://localhost/buildmap_test python -m pytest
+"""
+import os
+
+import pytest
+import sqlalchemy
+from sqlalchemy.sql import text
+
+from buildmap.mapdb import MapDB
+
+DB_URL = os.environ.get("BUILDMAP_TEST_DB_URL")
+
+pytestmark = pytest.mark.skipif(
+    DB_URL is None, reason="BUILDMAP_TEST_DB_URL is not set"
+)
+
+# rawcodevalues for each row of the fixture table, as ogr2ogr would import them
+FIXTURE = [
+    # A simple attribute, with hyphens which become spaces
+    ["1001 BUILDMAP", "1000 name:main-bar"],
+    # Duplicate keys - the last one wins
+    ["1000 power:16A", "1000 power:32A", "1000 power:63A"],
+    # Values containing colons
+    ["1000 url:https://example.com:8080/path", "1000 time:12:30"],
+    # Mixed-case names, which are lowercased and so also duplicate each other
+    ["1000 Name:upper", "1000 NAME:shouting", "1000 Colour:red"],
+    # No XDATA at all
+    None,
+    # Codes without XDATA attributes
+    ["1001 BUILDMAP", "1000 no colon here", "1070 5"],
+    # Tabs, backslashes and newlines, which need escaping for COPY
+    ["1000 notes:tab\there", "1000 path:C:\\dxf\\site.dxf", "1000 lines:one\ntwo"],
+    # Spaces in values
+    ["1000 name:food court", "1000 power:32A"],
+]
+
+
+@pytest.fixture
+def db():
+    db = MapDB(DB_URL)
+    db.engine = sqlalchemy.create_engine(db.url)
+    db.conn = db.engine.connect()
+    yield db
+    for engine in ("python", "sql"):
+        db.conn.execute(text("DROP TABLE IF EXISTS test_attributes_%s" % engine))
+    db.conn.close()
+    db.engine.dispose()
+
+
+def extract(db, engine):
+    """Load the fixture into a table, extract its attributes with `engine`, and
+    return the attribute names, the table's columns and its rows."""
+    table = "test_attributes_%s" % engine
+    db.conn.execute(text("DROP TABLE IF EXISTS %s" % table))
+    db.conn.execute(
+        text(
+            """CREATE TABLE %s (ogc_fid SERIAL PRIMARY KEY, layer TEXT,
+                text TEXT, entityhandle TEXT, rawcodevalues TEXT[])"""
+            % table
+        )
+    )
+    for i, rawcodevalues in enumerate(FIXTURE):
+        db.conn.execute(
+            text(
+                """INSERT INTO %s (layer, entityhandle, rawcodevalues)
+                    VALUES ('layer', :handle, :rawcodevalues)"""
+                % table
+            ),
+            handle="%X" % (0x100 + i),
+            rawcodevalues=rawcodevalues,
+        )
+
+    with db.conn.begin():
+        attributes = db.extract_dxf_attributes(table, engine)
+
+    columns = db.get_columns(table)
+    rows = [
+        dict(row)
+        for row in db.conn.execute(text("SELECT * FROM %s ORDER BY ogc_fid" % table))
+    ]
+    return attributes, columns, rows
+
+
+def test_engines_match(db):
+    python = extract(db, "python")
+    sql = extract(db, "sql")
+
+    assert python[0] == sql[0]
+    assert python[1] == sql[1]
+    assert python[2] == sql[2]
+
+
+def test_attribute_values(db):
+    attributes, columns, rows = extract(db, "sql")
+
+    assert attributes == {
+        "name",
+        "power",
+        "url",
+        "time",
+        "colour",
+        "notes",
+        "path",
+        "lines",
+        "text",
+        "entityhandle",
+    }
+    assert "rawcodevalues" not in columns
+    assert rows[0]["name"] == "main bar"
+    assert rows[1]["power"] == "63A"
+    assert rows[2]["url"] == "https://example.com:8080/path"
+    assert rows[2]["time"] == "12:30"
+    assert rows[3]["name"] == "shouting"
+    assert rows[3]["colour"] == "red"
+    assert all(rows[4][name] is None for name in attributes - {"entityhandle"})
+    assert all(rows[5][name] is None for name in attributes - {"entityhandle"})
+    assert rows[6]["notes"] == "tab\there"
+    assert rows[6]["path"] == "C:\\dxf\\site.dxf"
+    assert rows[6]["lines"] == "one\ntwo"
+    assert rows[7]["name"] == "food court"
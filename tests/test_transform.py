@@ -0,0 +1,169 @@
+"""Check that several tables can be transformed, one after another, on the same
+`MapDB` connection.
+
+These tests need a PostgreSQL database, which may be overwritten. Set
+BUILDMAP_TEST_DB_URL to run them. `test_transform_tables` also needs PostGIS,
+and is skipped if it isn't installed.
+"""
+import json
+import os
+
+import pytest
+import sqlalchemy
+from shapely.geometry import Polygon
+from sqlalchemy.sql import text
+
+from buildmap.input import Input
+from buildmap.main import BuildMap
+from buildmap.mapdb import MapDB
+
+DB_URL = os.environ.get("BUILDMAP_TEST_DB_URL")
+
+pytestmark = pytest.mark.skipif(
+    DB_URL is None, reason="BUILDMAP_TEST_DB_URL is not set"
+)
+
+TABLES = ["test_plan_a", "test_plan_b"]
+
+
+def create_dxf_table(conn, table, geometry=True):
+    """Create a table which looks like one imported from a DXF by ogr2ogr."""
+    conn.execute(text("DROP TABLE IF EXISTS %s" % table))
+    conn.execute(
+        text(
+            """CREATE TABLE %s (ogc_fid SERIAL PRIMARY KEY, layer TEXT,
+                subclasses TEXT, text TEXT, ogr_style TEXT, entityhandle TEXT,
+                rawcodevalues TEXT[] %s)"""
+            % (table, ", wkb_geometry geometry(Geometry, 27700)" if geometry else "")
+        )
+    )
+    rows = [
+        (
+            "terrain ... tent",
+            None,
+            None,
+            "1A0",
+            ["1000 name:main-bar"],
+            "LINESTRING(350000 180000, 350010 180000, 350010 180010, "
+            "350000 180010, 350000 180000)",
+        ),
+        (
+            "terrain ... labels",
+            "Bar",
+            'LABEL(f:"Arial",t:"Bar",s:2g,a:45,c:#000026)',
+            "1A1",
+            None,
+            "POINT(350005 180005)",
+        ),
+    ]
+    for layer, label, style, handle, rawcodevalues, wkt in rows:
+        conn.execute(
+            text(
+                """INSERT INTO %s (layer, text, ogr_style, entityhandle, rawcodevalues%s)
+                    VALUES (:layer, :text, :style, :handle, :rawcodevalues%s)"""
+                % (
+                    table,
+                    ", wkb_geometry" if geometry else "",
+                    ", ST_GeomFromText(:wkt, 27700)" if geometry else "",
+                )
+            ),
+            layer=layer,
+            text=label,
+            style=style,
+            handle=handle,
+            rawcodevalues=rawcodevalues,
+            wkt=wkt,
+        )
+
+
+@pytest.fixture
+def db():
+    db = MapDB(DB_URL)
+    db.engine = sqlalchemy.create_engine(db.url)
+    db.conn = db.engine.connect()
+    yield db
+    for table in TABLES:
+        db.conn.execute(text("DROP TABLE IF EXISTS %s" % table))
+    db.conn.close()
+    db.engine.dispose()
+
+
+@pytest.mark.parametrize("engine", ["python", "sql"])
+def test_transaction_after_vacuum(db, engine):
+    """Temporary tables created after a VACUUM must last until the end of their
+    transaction."""
+    for table in TABLES:
+        create_dxf_table(db.conn, table, geometry=False)
+
+    db.vacuum(TABLES[0])
+    with db.conn.begin():
+        attributes = db.extract_dxf_attributes(TABLES[1], engine)
+    assert attributes == {"name", "text", "entityhandle"}
+
+
+@pytest.fixture
+def buildmap(tmp_path):
+    source_file = {}
+    for table in TABLES:
+        path = tmp_path / ("%s.dxf" % table)
+        path.touch()
+        source_file[table] = {"path": str(path)}
+
+    map_config = tmp_path / "map.conf.json"
+    map_config.write_text(
+        json.dumps(
+            {
+                "source_projection": "epsg:27700",
+                "zoom_range": [14, 18],
+                "source_file": source_file,
+            }
+        )
+    )
+    local_config = tmp_path / "local.conf.json"
+    local_config.write_text(
+        json.dumps(
+            {
+                "db_url": DB_URL,
+                "web_directory": str(tmp_path / "web"),
+                "output_directory": str(tmp_path / "output"),
+            }
+        )
+    )
+
+    buildmap = BuildMap([str(map_config), str(local_config)])
+    if not buildmap.db.connect():
+        pytest.skip("PostGIS is not installed")
+    yield buildmap
+    for table in TABLES + ["bounding_box"]:
+        buildmap.db.conn.execute(text("DROP TABLE IF EXISTS %s" % table))
+    buildmap.db.conn.close()
+    buildmap.db.engine.dispose()
+
+
+def test_transform_tables(buildmap):
+    db = buildmap.db
+    for table in TABLES:
+        create_dxf_table(db.conn, table)
+    db.create_bounding_layer(
+        "bounding_box", Polygon([(-3, 51), (-3, 52), (-2, 52), (-2, 51), (-3, 51)])
+    )
+
+    # Each transform runs a VACUUM, which mustn't break the next table's transform
+    for table in TABLES:
+        buildmap.transform_table(
+            Input(buildmap, table, buildmap.config["source_file"][table]), db
+        )
+
+    for table in TABLES:
+        assert {"name", "text_size", "text_rotation"} <= buildmap.known_attributes[
+            table
+        ]
+        rows = db.conn.execute(
+            text(
+                "SELECT name, text_size, text_rotation FROM %s ORDER BY ogc_fid" % table
+            )
+        ).fetchall()
+        assert [tuple(row) for row in rows] == [
+            ("main bar", None, None),
+            (None, 2.0, 45.0),
+        ]